@@ -6,12 +6,16 @@ local url_regex = "/^[a-z](?:[-a-z0-9\\+\\.])*:(?:\\/\\/(?:(?:%[0-9a-f][0-9a-f]|
 local current_song_time = nil
 local current_song_duration = nil
 local current_vol = nil
+local next_request_id = 0
 
 
 Instance.properties = properties({
 	{ name="Login", type="Action" },
 	{ name="Logout", type="Action" },
 	{ name="ConnectedAs", type="Text", value="Disconnected", ui={readonly=true} },
+	{ name="Status", type="Text", value="", ui={readonly=true} },
+	{ name="Account", type="Text", value="default", onUpdate="onAccountUpdate" },
+	{ name="Refresh", type="Action" },
 	{ name="Settings", type="PropertyGroup", ui = { expand = false }, items={
 		{ name="Device", type="PropertyGroup", ui = { expand = true }, items={
 			{ name="PlaybackDevice", type="Enum", items=Instance.devices, onUpdate="onDeviceUpdate" },
@@ -35,6 +39,10 @@ Instance.properties = properties({
 		{ name = "RefreshPlaylists", type = "Action" },
 		{ name = "PlayPlaylist", type = "Action" }
 	}},
+	{ name="Library", type="PropertyGroup", ui={expand=false}, items= {
+		{ name = "Search", type = "Text", value = "" },
+		{ name = "SearchAndPlay", type = "Action" }
+	}},
 	{ name="Events", type="PropertyGroup", ui={expand=false}, items={
 		{ name="onPlayingStarted", type="Alert", args={
 			song_name="[Song]",
@@ -46,7 +54,10 @@ Instance.properties = properties({
 			song_name="[Song]",
 			artist="[Artist]",
 			album_image_url="[URL]",
-			album_name="[Album]"} },
+			album_name="[Album]",
+			tempo=0,
+			energy=0,
+			key=0} },
 		{ name="onSongTimeUpdate", type="Alert", args={
 			current_time="[00:00]",
 			duration="[00:00]",
@@ -90,11 +101,8 @@ function Instance:onInit()
 end
 
 function Instance:send(cmd)
-	for retries=1, 5 do
-		if self.webSocket and self.webSocket:isConnected() then
-			self.webSocket:send(cmd)
-			break
-		end
+	if self.webSocket and self.webSocket:isConnected() then
+		self.webSocket:send(cmd)
 	end
 end
 
@@ -106,13 +114,26 @@ function Instance:send_action(action, data)
 	self:send(json.encode({ action }))
 end
 
+-- commands: { { action="play", data={...} }, { action="refresh_devices" }, ... }
+-- Results come back in a single 'batch_result' message
+function Instance:send_batch(commands)
+	for _, command in ipairs(commands) do
+		next_request_id = next_request_id + 1
+		command.id = next_request_id
+	end
+
+	self:send(json.encode({ "batch", commands }))
+end
+
 function Instance:connect()
 	self:attemptConnection()
 end
 
 function Instance:attemptConnection()
 	local host = getNetwork():getHost("localhost")
-	self.webSocket = host:openWebSocket("ws://localhost:38045/ws")
+	self.webSocket = host:openWebSocket(
+		"ws://localhost:38045/ws?stream=1&account=" .. self:getAccount()
+	)
 	self.webSocket:setAutoReconnect(true)
 
 	self.webSocket:addEventListener("onMessage", self, self.onMessage)
@@ -133,6 +154,23 @@ function Instance:_onWsConnected()
 	end
 end
 
+function Instance:getAccount()
+	local account = self.properties:find("Account"):getValue()
+	if account and account ~= "" then
+		return account
+	end
+	return "default"
+end
+
+-- The account is part of the websocket url, so switching accounts reconnects
+function Instance:onAccountUpdate()
+	if self.webSocket then
+		self.webSocket:setAutoReconnect(false)
+		self.webSocket:disconnect()
+		self:attemptConnection()
+	end
+end
+
 function Instance:_onWsDisconnected()
 
 end
@@ -187,9 +225,23 @@ end
 
 function Instance:onMessage(msg)
 	local payload = json.decode(msg)
-	local action, data = payload.action, payload.data
+	self:dispatch(payload.action, payload.data)
+end
+
+function Instance:onBatchResult(data)
+	for _, result in ipairs(data.results) do
+		if result.status == 'error' then
+			print("Command " .. tostring(result.action) .. " failed: " .. tostring(result.error))
+		elseif result.response then
+			self:dispatch(result.response.action, result.response.data)
+		end
+	end
+end
 
-	if action == 'spotify_connect' then
+function Instance:dispatch(action, data)
+	if action == 'batch_result' then
+		self:onBatchResult(data)
+	elseif action == 'spotify_connect' then
 		self:onSpotifyConnect(data)
 	elseif action == 'song_changed' then
 		self:onSongChanged(data)
@@ -204,12 +256,26 @@ function Instance:onMessage(msg)
 		self.properties.Settings.Device:find("PlaybackDevice"):setElements(self.devices.all_devices)
 	elseif action == 'playlists' then
 		self:onRefreshPlaylists(data)
+	elseif action == 'playlists_chunk' then
+		self:onPlaylistsChunk(data)
+	elseif action == 'playlists_done' then
+		if data.total == 0 then
+			self.properties.DefaultPlaylist:find("Playlist"):setElements({ "No Playlists" })
+		end
 	elseif action == 'error' then
 		local command = data.command
-		if command == 'play' then
+		-- Only fall back once, otherwise an outage turns into a retry storm
+		if command == 'play' and not self.retried_play then
+			self.retried_play = true
 			self.devices.current_device = nil
 			self:PlayPlaylist()
 		end
+	elseif action == 'service_status' then
+		if data.degraded then
+			self.properties.Status = "Spotify unavailable, retrying"
+		else
+			self.properties.Status = ""
+		end
 	elseif action == 'restart_me' then
 		getOS():run("Spotify Service", getLocalFolder() .. "ppspotify.exe")
 	end
@@ -229,8 +295,18 @@ function Instance:Play(playlist_uri)
 	self:send_action("play", { device_name=device_name })
 end
 
+function Instance:SearchAndPlay()
+	local query = self.properties.Library:find("Search"):getValue()
+	if query and query ~= "" then
+		self:send_action("search_play", {
+			query=query,
+			device_name=self.properties.Settings.Device:find("PlaybackDevice"):getValue()
+		})
+	end
+end
+
 function Instance:RefreshPlaylists()
-	self:send_action("refresh_playlists")
+	self:send_action("refresh_playlists", { stream=true })
 end
 
 function Instance:Pause()
@@ -253,7 +329,7 @@ end
 
 function Instance:onRepeatUpdate()
 	self:send_action("update", {
-		shuffle_state=self.properties.Settings.Modes:find("Shuffle"):getValue( )
+		repeat_state=self.properties.Settings.Modes:find("Repeat"):getValue( )
 	} )
 end
 
@@ -284,16 +360,36 @@ function Instance:onRefreshPlaylists(data)
 	self.properties.DefaultPlaylist:find("Playlist"):setElements(playlists)
 end
 
+function Instance:onPlaylistsChunk(data)
+	if data.seq == 0 or not self.playlists then
+		self.playlists = {}
+		self.playlist_names = {}
+	end
+
+	for name, uri in pairs(data.playlists) do
+		if not self.playlists[name] then
+			table.insert(self.playlist_names, name)
+		end
+		self.playlists[name] = uri
+	end
+
+	self.properties.DefaultPlaylist:find("Playlist"):setElements(self.playlist_names)
+end
+
 function Instance:onSongChanged(data)
 	local tblImages = {}
-	tblImages["Album Image"] = data.item.album.images[2].url
+	tblImages["Album Image"] = data.item.album.images[1].url
 	self.UserImageGroup:setObjects(tblImages)
 
+	local features = data.audio_features or {}
 	self.properties.Events.onSongChange:raise({
 		song_name = data.item.name,
 		artist = data.item.artists[1].name,
-		album_image_url = data.item.album.images[2].url,
-		album_name = data.item.artists[1].name
+		album_image_url = data.item.album.images[1].url,
+		album_name = data.item.artists[1].name,
+		tempo = features.tempo or 0,
+		energy = features.energy or 0,
+		key = features.key or 0
 	})
 	current_song_duration = math.floor(data.item.duration_ms / 1000)
 	current_song_time = math.floor(data.progress_ms / 1000)
@@ -321,15 +417,25 @@ function Instance:RefreshDevices()
 	self:send_action("refresh_devices")
 end
 
+-- Devices and playlists in one round trip, the devices come back in the
+-- 'batch_result' and the playlists are streamed as 'playlists_chunk'
+function Instance:Refresh()
+	self:send_batch({
+		{ action="refresh_devices" },
+		{ action="refresh_playlists", data={ stream=true } }
+	})
+end
+
 function Instance:onPlay(data)
+	self.retried_play = false
 	local tblImages = {}
-	tblImages["Album Image"] = data.item.album.images[2].url
+	tblImages["Album Image"] = data.item.album.images[1].url
 	self.UserImageGroup:setObjects(tblImages)
 
 	self.properties.Events.onPlayingStarted:raise({
 	song_name = data.item.name,
 	artist = data.item.artists[1].name,
-	album_image_url = data.item.album.images[2].url,
+	album_image_url = data.item.album.images[1].url,
 	album_name = data.item.artists[1].name
 	})
 	current_song_duration = math.floor(data.item.duration_ms / 1000)
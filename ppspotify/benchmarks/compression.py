@@ -0,0 +1,255 @@
+"""Compares websocket bytes and CPU per event with compression off, with
+aiohttp's default of deflating every frame, and with the size threshold
+the server uses
+
+Frames are deflated the same way aiohttp does for permessage-deflate, so
+no server or Spotify account is needed. Each mode sends the same session
+a streaming client gets: a connect, the playlists in chunks, then songs
+changing with the odd pause, resume and shuffle or repeat change in
+between. Every track, playlist and id in it is different, like a real
+session, and a single compressor is kept for the whole connection like
+aiohttp does:
+
+    python benchmarks/compression.py --threshold 1024 --songs 500
+"""
+
+import random
+import string
+import zlib
+
+from argparse import ArgumentParser
+from collections import Counter
+from json import dumps as json_dumps
+from time import process_time_ns
+
+# Matches `WS_COMPRESSION_THRESHOLD` in ppspotify.context
+DEFAULT_THRESHOLD = 1024
+
+MARKETS = [f"{a}{b}" for a in "ABCDEFGHIJKLMN" for b in "ABCDEFGHIJKLM"]
+
+WORDS = (
+    "love night heart fire dream blue river light gold summer rain dance "
+    "home city wild stars ocean shadow echo run lost young time sky storm"
+).split()
+
+BASE62 = string.ascii_letters + string.digits
+
+
+def spotify_id(rng: random.Random) -> str:
+    """A random 22 character base62 id like Spotify's"""
+    return "".join(rng.choices(BASE62, k=22))
+
+
+def title(rng: random.Random) -> str:
+    """A random name of one to four words"""
+    return " ".join(rng.choices(WORDS, k=rng.randint(1, 4))).title()
+
+
+def fake_artist(rng: random.Random) -> dict:
+    """Roughly the shape of a simplified artist object from Spotify"""
+    artist_id = spotify_id(rng)
+    return {
+        "external_urls": {"spotify": f"https://open.spotify.com/artist/{artist_id}"},
+        "href": f"https://api.spotify.com/v1/artists/{artist_id}",
+        "id": artist_id,
+        "name": title(rng),
+        "type": "artist",
+        "uri": f"spotify:artist:{artist_id}",
+    }
+
+
+def fake_track(rng: random.Random) -> dict:
+    """Roughly the shape and size of a track object from Spotify"""
+    track_id, album_id = spotify_id(rng), spotify_id(rng)
+    artists = [fake_artist(rng) for _ in range(rng.randint(1, 3))]
+    markets = rng.sample(MARKETS, rng.randint(40, len(MARKETS)))
+
+    return {
+        "album": {
+            "album_type": rng.choice(("album", "single", "compilation")),
+            "artists": artists[:1],
+            "available_markets": markets,
+            "id": album_id,
+            "images": [
+                {
+                    "height": size,
+                    "width": size,
+                    "url": f"https://i.scdn.co/image/{rng.randbytes(20).hex()}",
+                }
+                for size in (640, 300, 64)
+            ],
+            "name": title(rng),
+            "release_date": f"{rng.randint(1960, 2026)}-{rng.randint(1, 12):02d}-01",
+            "uri": f"spotify:album:{album_id}",
+        },
+        "artists": artists,
+        "available_markets": markets,
+        "duration_ms": rng.randint(90_000, 420_000),
+        "explicit": rng.random() < 0.2,
+        "id": track_id,
+        "is_local": False,
+        "name": title(rng),
+        "popularity": rng.randint(0, 100),
+        "track_number": rng.randint(1, 14),
+        "uri": f"spotify:track:{track_id}",
+    }
+
+
+def fake_features(rng: random.Random) -> dict:
+    """Roughly the shape of an audio features object from Spotify"""
+    return {
+        "danceability": round(rng.random(), 3),
+        "energy": round(rng.random(), 3),
+        "key": rng.randint(0, 11),
+        "loudness": round(rng.uniform(-20, 0), 3),
+        "mode": rng.randint(0, 1),
+        "tempo": round(rng.uniform(60, 180), 3),
+        "valence": round(rng.random(), 3),
+    }
+
+
+def fake_playing(rng: random.Random, playlist: str) -> dict:
+    """A currently playing response as the server sends it"""
+    return {
+        "timestamp": rng.randint(1_700_000_000_000, 1_800_000_000_000),
+        "context": {"type": "playlist", "uri": playlist},
+        "progress_ms": rng.randint(0, 3000),
+        "is_playing": True,
+        "item": fake_track(rng),
+        "currently_playing_type": "track",
+        "audio_features": fake_features(rng) if rng.random() < 0.8 else None,
+    }
+
+
+def session(songs: int, seed: int = 0) -> list[tuple[str, bytes]]:
+    """The events a client would be sent over a session with `songs` songs
+
+    Returns:
+        list[tuple[str, bytes]]: Action and encoded message of every event
+    """
+    rng = random.Random(seed)
+    playlists = {
+        f"{title(rng)} {n}": f"spotify:playlist:{spotify_id(rng)}" for n in range(300)
+    }
+    names = list(playlists)
+    events = [
+        (
+            "spotify_connect",
+            {
+                "name": title(rng),
+                "user_image_url": f"https://i.scdn.co/image/{rng.randbytes(20).hex()}",
+                "devices": {title(rng): rng.randbytes(20).hex() for _ in range(3)},
+                "current_device": None,
+                "is_playing": False,
+                "shuffle_state": False,
+                "repeat_state": "off",
+                "playlists": {},  # Streamed as `playlists_chunk` afterwards
+            },
+        )
+    ]
+
+    for seq, start in enumerate(range(0, len(names), 50)):
+        chunk = {name: playlists[name] for name in names[start : start + 50]}
+        events.append(("playlists_chunk", {"seq": seq, "playlists": chunk}))
+
+    events.append(("playlists_done", {"chunks": seq + 1, "total": len(names)}))
+
+    for _ in range(songs):
+        playlist = playlists[rng.choice(names)]
+        events.append(("song_changed", fake_playing(rng, playlist)))
+
+        if rng.random() < 0.1:
+            events.append(("playing_stopped", None))
+            events.append(("started_playing", fake_playing(rng, playlist)))
+        if rng.random() < 0.05:
+            events.append(("update", {"shuffle_state": rng.random() < 0.5}))
+        if rng.random() < 0.05:
+            events.append(
+                ("update", {"repeat_state": rng.choice(("off", "context", "track"))})
+            )
+
+    return [
+        (action, json_dumps({"action": action, "data": data}).encode())
+        for action, data in events
+    ]
+
+
+def frame_size(payload: int) -> int:
+    """Payload size plus a server to client websocket frame header"""
+    return payload + (2 if payload < 126 else 4 if payload < 65536 else 10)
+
+
+def deflate(compressobj, message: bytes) -> int:
+    """Deflates a message like permessage-deflate and returns its size"""
+    data = compressobj.compress(message) + compressobj.flush(zlib.Z_SYNC_FLUSH)
+    return len(data) - 4  # The trailing 00 00 ff ff isn't sent
+
+
+def run(
+    mode: str, events: list[tuple[str, bytes]], threshold: int
+) -> tuple[Counter, Counter]:
+    """Sends every event of a session over one connection in `mode`
+
+    Returns:
+        tuple[Counter, Counter]: bytes on the wire and nanoseconds of CPU,
+            both per action
+    """
+    compressor = zlib.compressobj(zlib.Z_BEST_SPEED, zlib.DEFLATED, -zlib.MAX_WBITS)
+    sizes: Counter[str] = Counter()
+    cpu: Counter[str] = Counter()
+
+    for action, message in events:
+        start = process_time_ns()
+
+        # Frames under the threshold skip the compressor and its window
+        if mode == "always" or (mode == "threshold" and len(message) >= threshold):
+            sizes[action] += frame_size(deflate(compressor, message))
+        else:
+            sizes[action] += frame_size(len(message))
+
+        cpu[action] += process_time_ns() - start
+
+    return sizes, cpu
+
+
+def main() -> None:  # pylint: disable=missing-function-docstring
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threshold", type=int, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--songs", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    events = session(args.songs, args.seed)
+    counts = Counter(action for action, _ in events)
+    raw: Counter[str] = Counter()
+    for action, message in events:
+        raw[action] += len(message)
+
+    modes = ("off", "always", "threshold")
+    results = [run(mode, events, args.threshold) for mode in modes]
+
+    print(f"{len(events)} events, bytes and CPU per event")
+    print(f"{'event':<18}{'count':>7}{'raw':>8}", *(f"{mode:>18}" for mode in modes))
+
+    for action, number in counts.items():
+        print(
+            f"{action:<18}{number:>7}{raw[action] // number:>8}",
+            *(
+                f"{sizes[action] // number:>8}B {cpu[action] / number / 1000:>6.1f}us"
+                for sizes, cpu in results
+            ),
+        )
+
+    total = len(events)
+    print(
+        f"{'session':<18}{total:>7}{sum(raw.values()) // total:>8}",
+        *(
+            f"{sum(sizes.values()) // total:>8}B "
+            f"{sum(cpu.values()) / total / 1000:>6.1f}us"
+            for sizes, cpu in results
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Replays a trace recorded in capture mode against the current build and
+reports latency and CPU per command, Spotify calls and messages sent
+
+The service runs for real apart from the network: `ReplaySpotify` stands
+in for Spotify and PolyPop is replaced by a client that counts what it's
+sent. It runs in a throwaway home directory, so every replay starts with
+cold caches and never touches the real settings:
+
+    PPSPOTIFY_TRACE=session.trace.gz ppspotify    # record a session
+    python benchmarks/replay.py session.trace.gz --speed 10
+
+Polling keeps its real one second interval, so a replay faster than 1x
+polls less of the session. Only compare runs made at the same speed
+"""
+
+import asyncio
+import io
+import os
+import sys
+
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from json import dumps as json_dumps
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import monotonic, perf_counter, process_time
+
+from loguru import logger
+from PIL import Image
+
+# Commands that would open a browser, delete credentials or stop the service
+SKIPPED_ACTIONS = {"login", "logout", "quit", "subscribe"}
+
+
+class ReplayClient:
+    """Stands in for PolyPop's websocket, counting the messages it's sent"""
+
+    compress = 0  # Never negotiates deflate, so frames are sized as encoded
+
+    def __init__(self) -> None:
+        self.sent: Counter[str] = Counter()
+        self.bytes = 0
+
+    async def send_str(self, message: str) -> None:
+        # Messages always start with `{"action": "<action>"`
+        self.sent[message.split('"', 4)[3]] += 1
+        self.bytes += len(message)
+
+    async def close(self) -> None:
+        pass
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest rank percentile, `fraction` between 0 and 1"""
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def replay(records: list[list], speed: float) -> dict:
+    """Feeds the websocket commands of a trace to a fresh `Server`, waiting
+    between them as long as the recording did, divided by `speed`
+
+    Returns:
+        dict: The measurements, see `report`
+    """
+    # Imported here so the package picks up the throwaway home directory
+    # pylint: disable=import-outside-toplevel
+    from requests.exceptions import RequestException
+    from spotipy.exceptions import SpotifyException
+
+    from ppspotify.context import SpotifyContext
+    from ppspotify.ppspotify import connect_context, handle_actions
+    from ppspotify.resilience import CircuitOpenError
+    from ppspotify.trace import API, COMMAND, CONNECT, SENT, ReplaySpotify
+    from ppspotify.web_app import Server
+
+    # Upcoming covers are downloaded from Spotify's CDN, which isn't part of
+    # the trace. Serve a generated one per url instead, so resizing them is
+    # still measured without touching the network
+    covers: dict[str, bytes] = {}
+
+    def download_artwork(_, url: str) -> bytes:
+        if (cover := covers.get(url)) is None:
+            output = io.BytesIO()
+            Image.effect_noise((640, 640), 64).convert("RGB").save(output, "JPEG")
+            cover = covers[url] = output.getvalue()
+        return cover
+
+    SpotifyContext.download_artwork = download_artwork  # type: ignore
+
+    started = monotonic()
+    position = 0.0  # Trace time of the last command, used when `speed` is 0
+
+    def clock() -> float:
+        if not speed:
+            return position
+        return (monotonic() - started) * 1000 * speed
+
+    api_records = defaultdict(list)
+    recorded_calls: Counter[str] = Counter()
+    recorded_sent: Counter[str] = Counter()
+
+    for record in records:
+        if record[1] == API:
+            api_records[record[2]].append(record)
+            recorded_calls[record[3]] += 1
+        elif record[1] == SENT:
+            recorded_sent[record[3]] += 1
+
+    stand_ins: dict[str, ReplaySpotify] = {}
+    clients: dict[str, ReplayClient] = {}
+    latencies: dict[str, list[float]] = defaultdict(list)
+    cpu: Counter[str] = Counter()
+    errors: Counter[str] = Counter()
+
+    app = Server()
+    cpu_start, wall_start = process_time(), perf_counter()
+
+    for at, kind, account, *fields in records:
+        if kind not in (CONNECT, COMMAND):
+            continue
+
+        if speed:
+            await asyncio.sleep(max(at / 1000 / speed - (monotonic() - started), 0))
+        else:
+            position = at
+
+        if (client := clients.get(account)) is None:
+            client = clients[account] = ReplayClient()
+            app.subscribe(client, account)  # type: ignore
+
+        if kind == CONNECT:
+            name = "(connect)"
+            if (spotify := stand_ins.get(account)) is None:
+                spotify = stand_ins[account] = ReplaySpotify(
+                    api_records[account], clock, speed
+                )
+        else:
+            payload = fields[0]
+            name = str(payload[0]) if payload else "(empty)"
+
+            if name in SKIPPED_ACTIONS:
+                continue
+
+        command_start, command_cpu = perf_counter(), process_time()
+
+        try:
+            if kind == CONNECT:
+                await connect_context(app, app.get_context(account), fields[0], spotify)
+            else:
+                await handle_actions(app, payload, client)  # type: ignore
+        except (CircuitOpenError, SpotifyException, RequestException, RuntimeError):
+            errors[name] += 1
+
+        latencies[name].append((perf_counter() - command_start) * 1000)
+        cpu[name] += (process_time() - command_cpu) * 1000
+
+    if speed and records:
+        # Let the pollers play out the rest of the session
+        end = max(record[0] for record in records)
+        await asyncio.sleep(max(end / 1000 / speed - (monotonic() - started), 0))
+
+    cpu_total = (process_time() - cpu_start) * 1000
+    wall_total = (perf_counter() - wall_start) * 1000
+    app.close()
+
+    calls: Counter[str] = Counter()
+    fallbacks: Counter[str] = Counter()
+    for stand_in in stand_ins.values():
+        calls.update(stand_in.calls)
+        fallbacks.update(stand_in.fallbacks)
+
+    sent: Counter[str] = Counter()
+    for client in clients.values():
+        sent.update(client.sent)
+
+    events = sum(len(values) for values in latencies.values()) + sum(sent.values())
+
+    return {
+        "speed": speed,
+        "wall_ms": round(wall_total, 3),
+        "cpu_ms": round(cpu_total, 3),
+        "cpu_ms_per_event": round(cpu_total / max(events, 1), 3),
+        "commands": {
+            name: {
+                "count": len(values),
+                "errors": errors[name],
+                "p50_ms": round(percentile(values, 0.5), 3),
+                "p95_ms": round(percentile(values, 0.95), 3),
+                "cpu_ms": round(cpu[name] / len(values), 3),
+            }
+            for name, values in sorted(latencies.items())
+        },
+        "api_calls": {
+            method: {
+                "count": calls[method],
+                "recorded": recorded_calls[method],
+                "fallbacks": fallbacks[method],
+            }
+            for method in sorted(calls | recorded_calls)
+        },
+        "sent": {
+            action: {"count": sent[action], "recorded": recorded_sent[action]}
+            for action in sorted(sent | recorded_sent)
+        },
+        "sent_bytes": sum(client.bytes for client in clients.values()),
+    }
+
+
+def report(results: dict) -> None:
+    """Prints the measurements as tables"""
+    print(
+        f"replayed at {results['speed']}x in {results['wall_ms'] / 1000:.1f}s, "
+        f"{results['cpu_ms']:.1f}ms CPU, "
+        f"{results['cpu_ms_per_event']:.3f}ms CPU per event"
+    )
+
+    print(f"\n{'command':<24}{'count':>8}{'errors':>8}{'p50 ms':>10}", end="")
+    print(f"{'p95 ms':>10}{'cpu ms':>10}")
+    for name, row in results["commands"].items():
+        print(
+            f"{name:<24}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10.2f}"
+            f"{row['p95_ms']:>10.2f}{row['cpu_ms']:>10.2f}"
+        )
+
+    # Fallbacks were answered with the response to a call with other arguments
+    print(f"\n{'spotify call':<24}{'count':>8}{'recorded':>10}{'fallbacks':>11}")
+    for name, row in results["api_calls"].items():
+        print(
+            f"{name:<24}{row['count']:>8}{row['recorded']:>10}{row['fallbacks']:>11}"
+        )
+
+    print(f"\n{'message sent':<24}{'count':>8}{'recorded':>10}")
+    for name, row in results["sent"].items():
+        print(f"{name:<24}{row['count']:>8}{row['recorded']:>10}")
+
+
+def main() -> None:  # pylint: disable=missing-function-docstring
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", type=Path)
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="0 replays as fast as possible"
+    )
+    parser.add_argument("--json", type=Path, help="Also write the results here")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    with TemporaryDirectory() as home:
+        os.environ["HOME"] = os.environ["USERPROFILE"] = home
+        os.environ.pop("PPSPOTIFY_TRACE", None)
+
+        # pylint: disable-next=import-outside-toplevel
+        from ppspotify.trace import load_trace
+
+        results = asyncio.run(replay(load_trace(args.trace), args.speed))
+        logger.remove()  # Closes the log file before its directory is deleted
+
+    report(results)
+
+    if args.json is not None:
+        args.json.write_text(json_dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Artwork pipeline that shrinks album covers before PolyPop loads them
+
+Covers embedded in local files are often several megabytes and thousands
+of pixels wide. They're resized and re-encoded in a process pool, so the
+event loop never decodes an image, and cached by a hash of the source
+image and the target size and format
+"""
+
+import asyncio
+import io
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha1
+from pathlib import Path
+from typing import Any
+
+from loguru import logger
+from PIL import Image
+
+from .store import write_atomic
+
+# Defaults for the `artwork_size` and `artwork_format` settings
+ARTWORK_SIZE = 300
+ARTWORK_FORMAT = "JPEG"
+
+# Pillow format name to file extension
+ARTWORK_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+MAX_WORKERS = 2
+
+
+def is_valid_artwork_size(size: Any) -> bool:
+    """Whether `size` can be used as the `artwork_size` setting
+
+    Args:
+        size (Any): Value sent by PolyPop
+
+    Returns:
+        bool: True for positive ints
+    """
+    return isinstance(size, int) and not isinstance(size, bool) and size > 0
+
+
+def is_valid_artwork_format(image_format: Any) -> bool:
+    """Whether `image_format` can be used as the `artwork_format` setting
+
+    Args:
+        image_format (Any): Value sent by PolyPop
+
+    Returns:
+        bool: True for the keys of `ARTWORK_FORMATS`
+    """
+    return isinstance(image_format, str) and image_format in ARTWORK_FORMATS
+
+
+def transcode(data: bytes, size: int, image_format: str) -> bytes:
+    """Resizes an image to fit in a `size` x `size` box and re-encodes it.
+    Runs in a worker process
+
+    Args:
+        data (bytes): The source image
+        size (int): Max width and height in pixels
+        image_format (str): One of `ARTWORK_FORMATS`
+
+    Returns:
+        bytes: The encoded image
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+        if image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=85, optimize=True)
+
+    return output.getvalue()
+
+
+def select_image(images: list[dict], size: int) -> dict | None:
+    """Picks the smallest of Spotify's image variants that's still at least
+    `size` pixels wide, or the largest one if none are big enough
+
+    Args:
+        images (list[dict]): `album.images` from Spotify
+        size (int): Target width in pixels
+
+    Returns:
+        dict | None: The chosen image object
+    """
+    if not images:
+        return None
+
+    by_width = sorted(images, key=lambda image: image.get("width") or 0)
+    return next(
+        (image for image in by_width if (image.get("width") or 0) >= size),
+        by_width[-1],
+    )
+
+
+class ArtworkPipeline:
+    """Resizes artwork in a process pool and caches the results on disk
+
+    Args:
+        cache_dir (Path): Where processed images are kept
+    """
+
+    __slots__ = "cache_dir", "executor"
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = cache_dir
+        self.executor: ProcessPoolExecutor | None = None
+
+    async def process(
+        self, data: bytes, size: int = ARTWORK_SIZE, image_format: str = ARTWORK_FORMAT
+    ) -> Path:
+        """Gets the path of `data` resized to `size` in `image_format`,
+        transcoding it only if it isn't cached yet
+
+        Args:
+            data (bytes): The source image
+            size (int, optional): Defaults to ARTWORK_SIZE.
+            image_format (str, optional): Defaults to ARTWORK_FORMAT.
+
+        Returns:
+            Path: The processed image, or a copy of the untouched source if
+                it couldn't be transcoded. Those copies aren't cached, so the
+                next call for the same image tries again
+        """
+        if image_format not in ARTWORK_FORMATS:
+            image_format = ARTWORK_FORMAT
+
+        source = sha1(data)
+        key = source.copy()
+        key.update(f"{size}:{image_format}".encode())
+        path = self.cache_dir.joinpath(
+            f"{key.hexdigest()}.{ARTWORK_FORMATS[image_format]}"
+        )
+
+        if path.exists():
+            return path
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+
+        try:
+            processed = await asyncio.get_running_loop().run_in_executor(
+                self.executor, transcode, data, size, image_format
+            )
+        except BrokenProcessPool as error:
+            logger.warning(f"Artwork workers died, using artwork as is: {error}")
+            self.close()
+            processed = None
+        except Exception as error:  # pylint: disable=broad-except
+            # Undecodable images, decompression bombs, anything Pillow raises.
+            # None of it should reach the now playing poller
+            logger.warning(f"Unable to resize artwork, using it as is: {error!r}")
+            processed = None
+
+        if processed is None:
+            # Kept apart from the cache so a failure, maybe only a passing
+            # one, never stands in for the transcoded image
+            path = path.with_name(
+                f"{source.hexdigest()}.source.{ARTWORK_FORMATS[image_format]}"
+            )
+            processed = data
+
+        await asyncio.to_thread(write_atomic, path, processed)
+        return path
+
+    def close(self) -> None:
+        """Stops the worker processes. New ones are started when needed"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -2,18 +2,22 @@
 
 import asyncio
 import io
+import re
+import sqlite3
 import sys
 import webbrowser
 
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from glob import glob
 from itertools import count
-from json import dump as json_dump, load as json_load, JSONDecodeError
+from json import dumps as json_dumps, load as json_load, JSONDecodeError
 from os import environ
 from pathlib import Path
 from socket import gethostname
-from typing import Callable, NoReturn
+from typing import Any, AsyncIterator, Callable, NoReturn
 
+from requests import Session
+from requests.exceptions import RequestException
 from spotipy import Spotify
 from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyOAuth
@@ -22,6 +26,21 @@ from loguru import logger
 from mutagen._file import File as SongLookupFile
 from yarl import URL
 
+from .artwork import (
+    ARTWORK_FORMAT,
+    ARTWORK_SIZE,
+    ArtworkPipeline,
+    is_valid_artwork_format,
+    is_valid_artwork_size,
+    select_image,
+)
+from .features import MAX_IDS_PER_REQUEST, AudioFeaturesCache
+from .library import LibraryIndex
+from .resilience import CircuitOpenError
+from .scheduler import ScheduledClient, Scheduler, SharedSession
+from .store import ConfigStore, write_atomic
+from .trace import TraceRecorder
+
 SPOTIFY_SCOPE = (
     "user-read-playback-state,user-library-read,user-modify-playback-state,"
     "user-read-currently-playing,playlist-read-private"
@@ -36,14 +55,47 @@ else:
 
 # Path related Constants
 DIRECTORY_PATH = Path.home().joinpath(f"PolyPop/UIX/{folder}")
-LOCAL_ARTWORK_PATH = DIRECTORY_PATH.joinpath("artwork.jpg")
-CREDENTIALS_PATH = DIRECTORY_PATH.joinpath(".creds")
-SPOTIFY_CACHE_DIR = DIRECTORY_PATH.joinpath(".cache")
+ARTWORK_CACHE_DIR = DIRECTORY_PATH.joinpath(".artwork")
+AUDIO_FEATURES_PATH = DIRECTORY_PATH.joinpath("audio_features.json")
+SERVER_SETTINGS_PATH = DIRECTORY_PATH.joinpath("server.json")
+ACCOUNTS_PATH = DIRECTORY_PATH.joinpath("accounts")
 COVER_IMAGE_APIC_NAMES = ["APIC:", "data", "cov"]
 
+# Per account file names, see `account_path`
+LIBRARY_FILE = "library.db"
+CREDENTIALS_FILE = ".creds"
+SPOTIFY_CACHE_FILE = ".cache"
+SETTINGS_FILE = "settings.json"
+
+# Account used by clients that never subscribe to a specific one
+DEFAULT_ACCOUNT = "default"
+ACCOUNT_NAME_REGEX = re.compile(r"[\w-]{1,64}")
+
+# Number of upcoming tracks to pre-resolve
+LOOKAHEAD_DEPTH = 3
+
+# Seconds to wait on Spotify's image CDN when pre-fetching artwork
+ARTWORK_DOWNLOAD_TIMEOUT = 5
+
+# Playlists per page, and per `playlists_chunk` when streaming them
+PLAYLIST_PAGE_SIZE = 50
+
+# Seconds in-between background syncs of the local library index
+LIBRARY_SYNC_INTERVAL = 300
+
 # PolyPop to Spotify conversion
 REPEAT_STATES = {"Song": "track", "Enabled": "context", "Disabled": "off"}
 
+# Defaults for the `ws_compression` and `ws_compression_threshold` server
+# settings. Frames smaller than the threshold (in bytes) are sent uncompressed.
+# Off by default, PolyPop connects over localhost where deflating costs far
+# more CPU than the bytes it saves, see benchmarks/compression.py
+WS_COMPRESSION = False
+WS_COMPRESSION_THRESHOLD = 1024
+
+# Capture mode, records a sanitised trace of the session to this file when set
+TRACE_PATH = environ.get("PPSPOTIFY_TRACE")
+
 # URL constants
 HOST, PORT, SPOTIFY_PORT = "localhost", 38045, 38042
 LOCALHOST_URL = URL(f"http://{HOST}:{PORT}")
@@ -57,6 +109,9 @@ async def exec_every_x_seconds(
 ) -> asyncio.Task:
     """Calls a function every x seconds
 
+    Errors are logged instead of ending the task, failing endpoints are
+    kept from being hammered by the scheduler's circuit breakers
+
     Args:
         every (int): the number of seconds to wait in-between calls
         func (Callable): function to call
@@ -64,13 +119,57 @@ async def exec_every_x_seconds(
 
     async def tasker():
         while True:
-            await func(*args, **kwargs)
+            try:
+                await func(*args, **kwargs)
+            except CircuitOpenError:
+                pass  # Already reported by the scheduler, try again next time
+            except (SpotifyException, RequestException) as error:
+                logger.warning(f"{func.__name__} failed: {error}")
+            except Exception as error:  # pylint: disable=broad-except
+                # Keep polling, a bug in one run shouldn't end the task for good
+                logger.exception(error)
+
             await asyncio.sleep(every)
 
     return asyncio.create_task(tasker())
 
 
-@dataclass
+def is_valid_account(account: str) -> bool:
+    """Account names end up in file paths so only allow simple ones
+
+    Args:
+        account (str)
+
+    Returns:
+        bool
+    """
+    return ACCOUNT_NAME_REGEX.fullmatch(account) is not None
+
+
+def account_path(account: str) -> Path:
+    """Gets the directory an account keeps its credentials, token cache and
+    library index in. The default account uses `DIRECTORY_PATH` so existing
+    installs keep working
+
+    Args:
+        account (str)
+
+    Raises:
+        ValueError: `account` isn't a valid account name
+
+    Returns:
+        Path
+    """
+    if not is_valid_account(account):
+        raise ValueError(f"Invalid account name: {account!r}")
+
+    if account == DEFAULT_ACCOUNT:
+        return DIRECTORY_PATH
+
+    return ACCOUNTS_PATH.joinpath(account)
+
+
+@dataclass(slots=True)
 class CredentialsManager:
     """Slightly shadow's Spotipy's auth manager due to it having issues
     handling cache and token refreshing
@@ -79,14 +178,28 @@ class CredentialsManager:
         _type_: _description_
     """
 
-    __slots__ = "client_id", "client_secret"
-
     client_id: str | None
     client_secret: str | None
+    account: str = DEFAULT_ACCOUNT
+
+    @property
+    def credentials_path(self) -> Path:
+        """Where this account's client id and secret are saved"""
+        return account_path(self.account).joinpath(CREDENTIALS_FILE)
+
+    @property
+    def cache_path(self) -> Path:
+        """Where Spotipy caches this account's tokens"""
+        return account_path(self.account).joinpath(SPOTIFY_CACHE_FILE)
 
     @classmethod
-    def load_from_file(cls: type["CredentialsManager"]) -> "CredentialsManager":
-        """Loads the users credentials from `SPOTIFY_CACHE_PATH`
+    def load_from_file(
+        cls: type["CredentialsManager"], account: str = DEFAULT_ACCOUNT
+    ) -> "CredentialsManager":
+        """Loads the users credentials from the account's `CREDENTIALS_FILE`
+
+        Args:
+            account (str, optional): Defaults to DEFAULT_ACCOUNT.
 
         Raises:
             FileNotFoundError: cache file either doesn't exist, doesn't have
@@ -95,17 +208,18 @@ class CredentialsManager:
         Returns:
             CredentialsManager
         """
+        credentials_path = account_path(account).joinpath(CREDENTIALS_FILE)
 
         def handle_corrupt_data(data: io.TextIOBase) -> NoReturn:
-            CREDENTIALS_PATH.unlink()
+            credentials_path.unlink()
             raise FileNotFoundError(
                 f"Credentials file corrupt. File has been deleted.\nOld Contents:\n{data.read()}"
             )
 
-        if not CREDENTIALS_PATH.exists():
-            raise FileNotFoundError(f'No Credentials File at "{CREDENTIALS_PATH}"')
+        if not credentials_path.exists():
+            raise FileNotFoundError(f'No Credentials File at "{credentials_path}"')
 
-        with open(CREDENTIALS_PATH, encoding="utf-8") as credentials_file:
+        with open(credentials_path, encoding="utf-8") as credentials_file:
             try:
                 credentials_data = json_load(credentials_file)
             except JSONDecodeError:
@@ -118,12 +232,16 @@ class CredentialsManager:
         if client_id is None or client_secret is None:
             handle_corrupt_data(credentials_file)
 
-        return cls(client_id, client_secret)
+        return cls(client_id, client_secret, account)
 
     def save_to_file(self) -> None:
-        """Saves credentials to file"""
-        with open(CREDENTIALS_PATH, "w", encoding="utf-8") as creds_file:
-            json_dump(asdict(self), creds_file)
+        """Saves credentials to file, replacing the old file atomically"""
+        write_atomic(
+            self.credentials_path,
+            json_dumps(
+                {"client_id": self.client_id, "client_secret": self.client_secret}
+            ).encode(),
+        )
 
     @property
     def auth_manager(self) -> SpotifyOAuth:
@@ -137,7 +255,7 @@ class CredentialsManager:
             client_secret=self.client_secret,
             redirect_uri=SPOTIFY_LOCALHOST_URL.human_repr(),
             scope=SPOTIFY_SCOPE,
-            cache_handler=CacheFileHandler(SPOTIFY_CACHE_DIR),
+            cache_handler=CacheFileHandler(self.cache_path),
         )
 
     def logout(self) -> None:
@@ -147,11 +265,11 @@ class CredentialsManager:
             None
         """
         try:
-            del self.client_id
-            del self.client_secret
+            self.client_id = None
+            self.client_secret = None
 
         finally:
-            SPOTIFY_CACHE_DIR.unlink()
+            self.cache_path.unlink(True)
 
 
 class SpotifyContext:
@@ -163,17 +281,35 @@ class SpotifyContext:
     Args:
         spotify (Spotify, optional): The Spotify Connection
         credentials_manager (CredentialsManager, optional)
+        account (str, optional): Name of the account this context is for
+        session (Session, optional): HTTP session shared with the other accounts
+        scheduler (Scheduler, optional): Scheduler shared with the other accounts
+        tasks (list[asyncio.Task]): Polling tasks started by `create_spotify`
         shuffle_state (bool, optional): Spotify's last known shuffle state
         repeat_state (bool, optional): Spotify's last known repeat state
         is_playing (bool, optional): Spotify's last known play/pause state
         playlists (dict, optional):
         current_device: str | None = None
         current_track: dict | None = None
-        __local_media_folder: str | None = None
+        current_context (str | None): Uri of the playlist or album being played
+        lookahead (dict): Pre-resolved upcoming tracks keyed by uri
+        lookahead_task (asyncio.Task | None): The running lookahead refresh
+        library (LibraryIndex | None): Local index of the users library
+        settings (ConfigStore): Persisted plugin settings for this account
+        artwork (ArtworkPipeline, optional): Pipeline shared with the other accounts
+        local_artwork (dict): Processed covers of local files keyed by file name
+        features (AudioFeaturesCache, optional): Cache shared with the other accounts
+        features_enabled (bool): False once Spotify refused this app audio features
+        recorder (TraceRecorder, optional): Records this account's Spotify
+            calls when capturing a trace
     """
 
     __slots__ = (
         "credentials_manager",
+        "account",
+        "session",
+        "scheduler",
+        "tasks",
         "spotify",
         "shuffle_state",
         "repeat_state",
@@ -181,19 +317,50 @@ class SpotifyContext:
         "playlists",
         "current_device",
         "current_track",
-        "__local_media_folder",
+        "lookahead",
+        "current_context",
+        "lookahead_task",
+        "library",
+        "settings",
+        "artwork",
+        "local_artwork",
+        "features",
+        "features_enabled",
+        "recorder",
     )
 
-    def __init__(self, credentials_manager: CredentialsManager | None = None) -> None:
+    def __init__(
+        self,
+        credentials_manager: CredentialsManager | None = None,
+        account: str = DEFAULT_ACCOUNT,
+        session: Session | None = None,
+        scheduler: Scheduler | None = None,
+        artwork: ArtworkPipeline | None = None,
+        features: AudioFeaturesCache | None = None,
+        recorder: TraceRecorder | None = None,
+    ) -> None:
         self.credentials_manager = credentials_manager
-        self.spotify: Spotify | None
-        self.shuffle_state: bool | None
-        self.repeat_state: str | None
-        self.is_playing: bool | None
-        self.playlists: dict | None
-        self.current_device: str | None
-        self.current_track: dict | None
-        self.__local_media_folder: str | None
+        self.account = account
+        self.session = session
+        self.scheduler = scheduler or Scheduler()
+        self.tasks: list[asyncio.Task] = []
+        self.spotify: Spotify | None = None
+        self.shuffle_state: bool | None = None
+        self.repeat_state: str | None = None
+        self.is_playing: bool | None = None
+        self.playlists: dict | None = None
+        self.current_device: str | None = None
+        self.current_track: dict | None = None
+        self.current_context: str | None = None
+        self.lookahead: dict[str, dict] = {}
+        self.lookahead_task: asyncio.Task | None = None
+        self.library: LibraryIndex | None = None
+        self.settings = ConfigStore(account_path(account).joinpath(SETTINGS_FILE))
+        self.artwork = artwork or ArtworkPipeline(ARTWORK_CACHE_DIR)
+        self.local_artwork: dict[str, Path] = {}
+        self.features = features or AudioFeaturesCache(AUDIO_FEATURES_PATH)
+        self.features_enabled = True
+        self.recorder = recorder
 
     @property
     def local_media_folder(self) -> str | None:
@@ -202,7 +369,7 @@ class SpotifyContext:
         Returns:
             str | None
         """
-        return self.__local_media_folder
+        return self.settings.get("local_media_folder")
 
     @local_media_folder.setter
     def local_media_folder(self, value: str) -> None:
@@ -211,13 +378,9 @@ class SpotifyContext:
         Args:
             value (str): The path to the directory to search for song files with artwork
         """
-        with open(LOCAL_ARTWORK_PATH, "w", encoding="utf-8") as artwork_file:
-            json_dump(value, artwork_file)
+        self.settings.set("local_media_folder", value)
 
-        self.__local_media_folder = value
-
-    @staticmethod
-    def request_credentials_from_user(delete_old: bool = True) -> None:
+    def request_credentials_from_user(self, delete_old: bool = True) -> None:
         """opens the browser for user to provide credentials information
 
         Does not actually set credentials in this function.
@@ -228,53 +391,129 @@ class SpotifyContext:
                 Defaults to True.
         """
         if delete_old:
-            CREDENTIALS_PATH.unlink(True)
+            account_path(self.account).joinpath(CREDENTIALS_FILE).unlink(True)
 
-        startup_url = LOCALHOST_URL.with_path("/startup")
+        startup_url = LOCALHOST_URL.with_path("/startup").with_query(
+            account=self.account
+        )
         logger.debug(f"Opening: {startup_url}")
-        webbrowser.open(LOCALHOST_URL.with_path("/startup").human_repr())
+        webbrowser.open(startup_url.human_repr())
 
     def logout(self) -> None:
         """alias for CredentialsManager.logout"""
         if self.credentials_manager:
             self.credentials_manager.logout()
 
+    async def call(self, method: str, *args, **kwargs) -> Any:
+        """Calls a method of the Spotify connection in a worker thread
+
+        Spotipy is blocking, so running it off of the event loop lets
+        independent commands and the polling tasks run concurrently.
+        Goes through the shared `Scheduler` so every account backs off
+        together when rate limited
+
+        Args:
+            method (str): Name of the `Spotify` method to call
+
+        Returns:
+            Any: Whatever the Spotipy method returns
+        """
+        if self.spotify is None:
+            return None
+
+        return await self.scheduler.run(
+            method, getattr(self.spotify, method), *args, **kwargs
+        )
+
     async def create_spotify(
-        self, app, client_id: str | None = None, client_secret: str | None = None
+        self,
+        app,
+        client_id: str | None = None,
+        client_secret: str | None = None,
+        stream_playlists: bool = False,
+        spotify: Spotify | None = None,
     ) -> tuple[str, dict] | None:
         """Creates the Spotify Connection
 
+        Args:
+            stream_playlists (bool, optional): Leave the playlists out of
+                `spotify_connect` because the caller will send them with
+                `stream_playlists`. Defaults to False.
+            spotify (Spotify, optional): Connect with this instead of the
+                stored credentials, e.g. a `ReplaySpotify`. Defaults to None.
+
         Returns:
             Spotify | None: Returns Spotify if successful, otherwise None
         """
-        if client_id is None and client_secret is None:
-            try:
-                self.credentials_manager = CredentialsManager.load_from_file()
-
-            except FileNotFoundError as error:
-                logger.debug(error.args)
-                return
+        if spotify is None:
+            if client_id is None and client_secret is None:
+                try:
+                    self.credentials_manager = CredentialsManager.load_from_file(
+                        self.account
+                    )
+
+                except FileNotFoundError as error:
+                    logger.debug(error.args)
+                    return
 
-        else:
-            self.credentials_manager = CredentialsManager(
-                client_id=client_id, client_secret=client_secret
-            )
+            elif (
+                credentials := CredentialsManager(
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    account=self.account,
+                )
+            ) != self.credentials_manager or not credentials.credentials_path.exists():
+                # Only new credentials need saving, the rest were loaded from disk.
+                # Unless the file is gone, e.g. deleted by a login
+                credentials.save_to_file()
+                self.credentials_manager = credentials
+
+            if (
+                spotify := Spotify(
+                    client_credentials_manager=self.credentials_manager.auth_manager,
+                    requests_session=SharedSession(self.session)
+                    if self.session is not None
+                    else True,
+                )
+            ) is None:
+                raise RuntimeError("Incorrect credentials")
 
-        if (
-            spotify := Spotify(
-                client_credentials_manager=self.credentials_manager.auth_manager
-            )
-        ) is None:
-            raise RuntimeError("Incorrect credentials")
+            if self.recorder is not None:
+                spotify = self.recorder.wrap(spotify, self.account)
 
         self.spotify = spotify
-        self.credentials_manager.save_to_file()
+        self.features_enabled = True
+
+        try:
+            return await self.start_session(app, stream_playlists)
+        except BaseException:
+            # Left half connected, `subscribe` would take the account for
+            # connected and never try again
+            self.cancel_tasks()
+            self.spotify = None
+            raise
+
+    async def start_session(
+        self, app, stream_playlists: bool = False
+    ) -> tuple[str, dict]:
+        """Reads the users profile and playback state from the freshly
+        created connection and starts the polling tasks
+
+        Args:
+            stream_playlists (bool, optional): See `create_spotify`.
+                Defaults to False.
 
-        user_profile = spotify.me()
+        Raises:
+            RuntimeError: Spotify didn't return the users profile
+
+        Returns:
+            tuple[str, dict]: The `spotify_connect` message
+        """
+        user_profile = await self.call("me")
         if user_profile is None:
             raise RuntimeError("Profile not found")
 
-        current_playback = spotify.current_playback() or {}
+        current_playback = await self.call("current_playback") or {}
         profile_image = user_profile.get("images")
         current_track = current_playback.get("item", {})
         self.current_device = current_playback.get("device", {}).get("name", "")
@@ -285,7 +524,17 @@ class SpotifyContext:
             None if current_track is not None else current_track.get("id")
         )
 
-        await exec_every_x_seconds(1, self.check_now_playing, app)
+        # Reconnecting shouldn't leave the old pollers running alongside the new ones
+        self.cancel_tasks()
+        self.tasks.append(await exec_every_x_seconds(1, self.check_now_playing, app))
+
+        if self.library is None:
+            self.library = LibraryIndex(
+                account_path(self.account).joinpath(LIBRARY_FILE)
+            )
+        self.tasks.append(
+            await exec_every_x_seconds(LIBRARY_SYNC_INTERVAL, self.sync_library)
+        )
 
         return (
             "spotify_connect",
@@ -294,22 +543,40 @@ class SpotifyContext:
                 "user_image_url": ""
                 if not profile_image
                 else profile_image[0].get("url"),
-                "devices": self.get_devices(),
+                "devices": await self.get_devices(),
                 "current_device": self.current_device,
                 "is_playing": self.is_playing,
                 "shuffle_state": self.shuffle_state,
                 "repeat_state": self.repeat_state,
-                "playlists": self.get_all_playlists(),
+                "playlists": {}
+                if stream_playlists
+                else await self.get_all_playlists(),
             },
         )
 
+    def cancel_tasks(self) -> None:
+        """Stops the polling tasks started by `create_spotify`"""
+        for task in self.tasks:
+            task.cancel()
+
+        self.tasks.clear()
+
     def close(self):
         """Closes the spotify connection
 
         If you see the spotipy docs it's done in the __del__ method
         """
-        if hasattr(self, "spotify"):
-            del self.spotify
+        self.cancel_tasks()
+        self.settings.flush()
+        self.spotify = None
+
+        if self.lookahead_task is not None:
+            self.lookahead_task.cancel()
+            self.lookahead_task = None
+
+        if self.library is not None:
+            self.library.close()
+            self.library = None
 
     async def refresh_spotify(self) -> None:
         """Gets new access tokens, etc... and saves to cache file"""
@@ -318,28 +585,85 @@ class SpotifyContext:
     async def update_settings(self, data: dict) -> None:
         """Catch all for updating general Spotify settings.
 
+        Settings kept by the service are saved even before connecting to
+        Spotify. The player's volume, shuffle and repeat are only changed
+        when `data` has them
+
         Args:
             data (dict): Should have the new settings and values to set
         """
-        if (spotify := self.spotify) is None:
-            return
+        if (new_media_folder := data.get("local_media_folder")) is not None:
+            self.local_media_folder = new_media_folder
+
+        for key, is_valid in (
+            ("artwork_size", is_valid_artwork_size),
+            ("artwork_format", is_valid_artwork_format),
+        ):
+            if (value := data.get(key)) is None:
+                continue
 
-        new_shuffle = (get_val := data.get)("shuffle_state", False)
-        new_repeat = get_val("repeat_state", "Disabled")
-        new_volume = get_val("volume")
+            if not is_valid(value):
+                logger.warning(f"Ignoring invalid {key}: {value!r}")
+                continue
+
+            self.settings.set(key, value)
+            self.local_artwork.clear()
+            self.lookahead.clear()  # Its artwork was resolved for the old settings
 
-        if new_volume is not None:
-            spotify.volume(new_volume)
+        if self.spotify is None:
+            return
 
-        if new_shuffle:
-            spotify.shuffle(state=new_shuffle)
+        if (new_volume := data.get("volume")) is not None:
+            await self.call("volume", new_volume)
+
+        if "shuffle_state" in data:
+            new_shuffle = bool(data["shuffle_state"])
+            await self.call("shuffle", state=new_shuffle)
             self.shuffle_state = new_shuffle
 
-        if new_repeat:
-            self.repeat({"state": new_repeat})
+        if "repeat_state" in data:
+            new_repeat = data["repeat_state"]
+            await self.repeat({"state": new_repeat})
             self.repeat_state = new_repeat
 
-    def get_all_playlists(self) -> dict[str, str] | None:
+    async def iter_playlist_pages(self) -> AsyncIterator[dict[str, str]]:
+        """Yields the current users playlists a page at a time, as soon
+        as each page arrives
+
+        Yields:
+            dict: {playlist_name: playlist_uri}
+        """
+        counter = count(0, PLAYLIST_PAGE_SIZE)
+
+        while page := await self.call(
+            "current_user_playlists", limit=PLAYLIST_PAGE_SIZE, offset=next(counter)
+        ):
+            yield {playlist["name"]: playlist["uri"] for playlist in page["items"]}
+
+            if page.get("next") is None:
+                break
+
+    async def stream_playlists(self, app) -> None:
+        """Sends the users playlists as a `playlists_chunk` per page followed
+        by `playlists_done`, so PolyPop can show the first ones right away
+        and never has to decode every playlist in a single message"""
+        if self.spotify is None:
+            return
+
+        seq = total = 0
+
+        async for playlists in self.iter_playlist_pages():
+            await app.broadcast(
+                "playlists_chunk", {"seq": seq, "playlists": playlists}, self.account
+            )
+            seq += 1
+            total += len(playlists)
+
+        await app.broadcast(
+            "playlists_done", {"chunks": seq, "total": total}, self.account
+        )
+
+    async def get_all_playlists(self) -> dict[str, str] | None:
         """Gets all of the current users playlists
 
         Args:
@@ -352,20 +676,15 @@ class SpotifyContext:
             return
 
         all_playlists = {}
-        counter = count(0, 50)
 
-        while (
-            playlists := self.spotify.current_user_playlists(offset=next(counter))
-        ) and playlists.get("next") is not None:
-            all_playlists.update(
-                {playlist["name"]: playlist["uri"] for playlist in playlists["items"]}
-            )
+        async for playlists in self.iter_playlist_pages():
+            all_playlists.update(playlists)
 
         if all_playlists:
             logger.debug(all_playlists)
         return all_playlists or {"0": "No Playlists"}
 
-    def get_devices(self) -> dict | None:
+    async def get_devices(self) -> dict | None:
         """Get all the users currently available devices
 
         Args:
@@ -374,62 +693,135 @@ class SpotifyContext:
         Returns:
             dict: In the form of: {device name: device id, ...}
         """
-        if (spotify := self.spotify) is None or (devices := spotify.devices()) is None:
+        if self.spotify is None or (devices := await self.call("devices")) is None:
             return None
 
         return {device["name"]: device["id"] for device in devices.get("devices")}
 
-    async def play(self, data: dict, retries: int = 0) -> tuple | None:
+    async def play(self, data: dict) -> tuple | None:
         """Starts Playing a song or Playlist. If failure then it retries
-        by downgrading to a more do-able play event
+        by downgrading to a more do-able play event, first other likely
+        devices and finally whatever device Spotify picks
+
+        Transient failures are already retried by the scheduler, so they
+        are reported straight away instead of walking the fallbacks
 
         Args:
-            app (web.Application)
-            spotify (Spotify)
-            self (SpotifyContext)
             data (dict)
-            retries (int, optional): Number of times to try downgrading Play event. Defaults to 0.
         """
         logger.debug(data)
         if self.spotify is None:
             return
 
-        if (devices := self.get_devices()) is None:
+        if (devices := await self.get_devices()) is None:
             return
 
-        device_id = devices.get(data.get("device_name"), self.current_device)
         playlist = data.get("playlist_uri")
+        track = data.get("track_uri")
 
         if self.is_playing:
-            if playlist is None:
+            if playlist is None and track is None:
                 return
 
+        kwargs = {}
+        if track is not None:
+            kwargs["uris"] = [track]
+        elif playlist is not None:
+            kwargs["context_uri"] = playlist
+
+        device_names = (
+            data.get("device_name"),
+            gethostname(),
+            environ.get("COMPUTERNAME"),
+        )
+        attempts = [
+            {"device_id": devices.get(name, self.current_device), **kwargs}
+            for name in device_names
+        ]
+        attempts.append({})
+        failure = None
+
+        for attempt in attempts:
+            try:
+                await self.call("start_playback", **attempt)
+                return
+
+            except SpotifyException as error:
+                failure = error
+                if error.http_status >= 500 or error.http_status == 429:
+                    break
+                logger.debug(f"Play failed with {attempt}: {error.msg}")
+
+            except (CircuitOpenError, RequestException) as error:
+                return "error", {"command": "play", "msg": str(error), "reason": None}
+
+        return "error", {
+            "command": "play",
+            "msg": failure.msg,  # type: ignore
+            "reason": failure.reason,  # type: ignore
+        }
+
+    async def sync_library(self) -> None:
+        """Brings the local library index up to date in a scheduler job thread.
+        Every Spotify call the sync makes goes through the scheduler on its own"""
+        if self.spotify is None or self.library is None:
+            return
+
+        spotify = ScheduledClient(
+            self.spotify, self.scheduler, asyncio.get_running_loop()
+        )
+
         try:
-            if playlist is None:
-                self.spotify.start_playback(device_id=device_id)
-            else:
-                self.spotify.start_playback(device_id=device_id, context_uri=playlist)
-
-        except SpotifyException as error:
-            match retries:
-                case 0:
-                    data["device_name"] = gethostname()
-                    return await self.play(data, 1)
-
-                case 1:
-                    data["device_name"] = environ["COMPUTERNAME"]
-                    return await self.play(data, 2)
-                case 2:
-                    self.spotify.start_playback()
-                    return
-                case _:
-                    return "error", {
-                        "command": "play",
-                        "msg": error.msg,
-                        "reason": error.reason,
-                    }
-
-    def repeat(self, data: dict) -> None:
+            await self.scheduler.run_job(self.library.sync, spotify)
+        except (CircuitOpenError, SpotifyException, RequestException) as error:
+            logger.warning(f"Library sync failed: {error}")
+        except sqlite3.Error as error:
+            logger.exception(error)
+
+    async def search(self, data: dict) -> tuple | None:
+        """Searches the local library index
+
+        Args:
+            data (dict): `query`, optionally `kind` ("track" or "playlist") and `limit`
+
+        Returns:
+            tuple: ("search_results", {"query": ..., "results": [...]})
+        """
+        if self.library is None:
+            return
+
+        query = data.get("query", "")
+        return "search_results", {
+            "query": query,
+            "results": self.library.search(
+                query, data.get("kind"), data.get("limit", 10)
+            ),
+        }
+
+    async def search_play(self, data: dict) -> tuple | None:
+        """Plays the best match in the local library index for `query`
+
+        Args:
+            data (dict): `query`, optionally `kind` and `device_name`
+
+        Returns:
+            tuple | None: An error if nothing matched, otherwise whatever `play` returns
+        """
+        if self.library is None:
+            return
+
+        if not (
+            results := self.library.search(data.get("query", ""), data.get("kind"), 1)
+        ):
+            return "error", {"command": "search_play", "msg": "No matches found"}
+
+        best = results[0]
+        key = "track_uri" if best["kind"] == "track" else "playlist_uri"
+        return await self.play(
+            {"device_name": data.get("device_name"), key: best["uri"]}
+        )
+
+    async def repeat(self, data: dict) -> None:
         """Calls `self.spotify.repeat` with the re-munged state
 
         Args:
@@ -437,7 +829,7 @@ class SpotifyContext:
         """
         if self.spotify is None:
             return
-        self.spotify.repeat(REPEAT_STATES[data.get("state", "Disabled")])
+        await self.call("repeat", REPEAT_STATES[data.get("state", "Disabled")])
 
     async def refresh_devices(self) -> tuple | None:
         """Sends current available devices to client"""
@@ -448,7 +840,7 @@ class SpotifyContext:
             "devices",
             {
                 "devices": []
-                if (devices := self.get_devices()) is None
+                if (devices := await self.get_devices()) is None
                 else list(devices)
             },
         )
@@ -457,16 +849,17 @@ class SpotifyContext:
         """Sends current available playlists to client"""
         if self.spotify is None:
             return
-        logger.debug(self.get_all_playlists())
-        return "playlists", self.get_all_playlists()
+        playlists = await self.get_all_playlists()
+        logger.debug(playlists)
+        return "playlists", {"playlists": playlists}
 
     async def check_spotify_settings(self, app) -> None:
         """Checks for current spotify settings.
         If something changes then broadcasts the changes"""
-        if (spotify := self.spotify) is None:
+        if self.spotify is None:
             return
 
-        if (info := spotify.current_playback()) is None:
+        if (info := await self.call("current_playback")) is None:
             return
 
         get_info = info.get
@@ -480,19 +873,18 @@ class SpotifyContext:
             states["repeat_state"] = self.repeat_state = new_repeat
 
         if states:
-            await app.broadcast("update", states)
+            await app.broadcast("update", states, self.account)
 
-    def get_local_artwork(self, name: str) -> Path | None:
+    def extract_local_artwork(self, name: str) -> bytes | None:
         """Looks in the local directory recursively to find a matching
-        filename to `name` and if so, tries to extract the album cover
-        and save it to file and returns the path to the saved image,
-        otherwise returns `None`
+        filename to `name` and if so, tries to extract the album cover.
+        Blocking, so run it in a worker thread
 
         Args:
             name (str): The file name to search for
 
         Returns:
-            str | None: The path to the album cover file or None if not found
+            bytes | None: The embedded album cover or None if not found
         """
         if self.local_media_folder is None:
             return None
@@ -514,62 +906,316 @@ class SpotifyContext:
         for apic_name in COVER_IMAGE_APIC_NAMES:
             if apic_name not in song_file.tags:  # type: ignore
                 continue
-            logger.debug(f"{LOCAL_ARTWORK_PATH}")
-            artwork = song_file.tags[name].data  # type: ignore
+            artwork = song_file.tags[apic_name].data  # type: ignore
+
+        return artwork
+
+    async def get_local_artwork(self, name: str) -> Path | None:
+        """Gets the album cover of a local file, resized by the artwork
+        pipeline to the `artwork_size` and `artwork_format` settings
+
+        Args:
+            name (str): The file name to search for
 
+        Returns:
+            Path | None: The path to the album cover file or None if not found
+        """
+        if self.local_media_folder is None:
+            return None
+
+        if (path := self.local_artwork.get(name)) is not None and path.exists():
+            return path
+
+        artwork = await asyncio.to_thread(self.extract_local_artwork, name)
         if artwork is None:
+            return None
+
+        path = self.local_artwork[name] = await self.artwork.process(
+            artwork, self.artwork_size, self.artwork_format
+        )
+        return path
+
+    @property
+    def artwork_size(self) -> int:
+        """Width and height artwork is resized to"""
+        size = self.settings.get("artwork_size", ARTWORK_SIZE)
+        return size if is_valid_artwork_size(size) else ARTWORK_SIZE
+
+    @property
+    def artwork_format(self) -> str:
+        """Image format artwork is re-encoded to"""
+        image_format = self.settings.get("artwork_format", ARTWORK_FORMAT)
+        return image_format if is_valid_artwork_format(image_format) else ARTWORK_FORMAT
+
+    async def resolve_item(self, item: dict) -> dict:
+        """Picks the artwork PolyPop should load for a track. Local tracks
+        get the cover found on disk, others get the smallest Spotify image
+        that's at least `artwork_size`, moved to the front of the list
+
+        Args:
+            item (dict): A track object from Spotify
+
+        Returns:
+            dict: The same track object, ready to be sent to PolyPop
+        """
+        album = item.get("album") or {}
+
+        if item.get("is_local"):
+            name = item["uri"].split(":")[-2]
+            if local_artwork := await self.get_local_artwork(name):
+                album["images"] = [self.artwork_image(local_artwork)]
+
+        elif (images := album.get("images")) and (
+            selected := select_image(images, self.artwork_size)
+        ):
+            album["images"] = [
+                selected,
+                *(image for image in images if image is not selected),
+            ]
+
+        return item
+
+    def artwork_image(self, path: Path) -> dict:
+        """Image object pointing PolyPop at a processed cover on disk
+
+        Args:
+            path (Path): From the artwork pipeline
+
+        Returns:
+            dict
+        """
+        return {
+            "url": path.as_uri().replace("/", "\\"),
+            "width": self.artwork_size,
+            "height": self.artwork_size,
+        }
+
+    def download_artwork(self, url: str) -> bytes:
+        """Downloads an image from Spotify's CDN. Blocking, so run it in a
+        worker thread
+
+        Args:
+            url (str)
+
+        Raises:
+            RequestException: The download failed
+
+        Returns:
+            bytes
+        """
+        response = (self.session or Session()).get(
+            url, timeout=ARTWORK_DOWNLOAD_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.content
+
+    async def prefetch_artwork(self, item: dict) -> dict:
+        """Downloads the image `resolve_item` picked for a Spotify track and
+        runs it through the artwork pipeline ahead of time, so PolyPop loads
+        a small local file once the track starts. Spotify's own images are
+        kept behind it, and left as they are if the download fails
+
+        Args:
+            item (dict): A track object already passed through `resolve_item`
+
+        Returns:
+            dict: The same track object
+        """
+        album = item.get("album") or {}
+
+        if (
+            item.get("is_local")
+            or not (images := album.get("images"))
+            or not (url := images[0].get("url"))
+        ):
+            return item
+
+        try:
+            data = await asyncio.to_thread(self.download_artwork, url)
+        except RequestException as error:
+            logger.debug(f"Unable to pre-fetch artwork: {error}")
+            return item
+
+        path = await self.artwork.process(data, self.artwork_size, self.artwork_format)
+        album["images"] = [self.artwork_image(path), *images]
+        return item
+
+    async def upcoming_from_context(self) -> list[dict]:
+        """Works out the next tracks from the playlist or album being played,
+        for when Spotify's queue is empty or can't be read. Playlists come
+        from the library index, albums from Spotify. Nothing is guessed
+        while shuffling since the play order isn't known then
+
+        Returns:
+            list[dict]: Up to `LOOKAHEAD_DEPTH` track objects
+        """
+        if (
+            self.shuffle_state
+            or self.current_context is None
+            or self.current_track is None
+        ):
+            return []
+
+        current = f"spotify:track:{self.current_track}"
+        _, kind, context_id = self.current_context.split(":", 2)
+
+        if kind == "playlist" and self.library is not None:
+            uris = self.library.upcoming(self.current_context, current, LOOKAHEAD_DEPTH)
+        elif kind == "album":
+            album = await self.call("album_tracks", context_id, limit=50) or {}
+            uris = [item["uri"] for item in album.get("items", [])]
+            uris = uris[uris.index(current) + 1 :] if current in uris else []
+        else:
+            return []
+
+        if not (uris := uris[:LOOKAHEAD_DEPTH]):
+            return []
+
+        tracks = await self.call("tracks", [uri.split(":")[-1] for uri in uris]) or {}
+        return [track for track in tracks.get("tracks", []) if track]
+
+    async def refresh_lookahead(self) -> None:
+        """Pre-resolves the next few tracks in the users queue, or in the
+        playlist or album being played, so that `song_changed` can be sent
+        without waiting on artwork or audio features"""
+        if self.spotify is None:
+            return
+
+        try:
+            upcoming = (await self.call("queue") or {}).get("queue") or []
+        except (CircuitOpenError, SpotifyException, RequestException) as error:
+            logger.debug(f"Unable to read queue: {error}")
+            upcoming = []
+
+        if not upcoming:
+            try:
+                upcoming = await self.upcoming_from_context()
+            except (CircuitOpenError, SpotifyException, RequestException) as error:
+                logger.debug(f"Unable to read upcoming tracks: {error}")
+
+        lookahead = {}
+        for item in upcoming[:LOOKAHEAD_DEPTH]:
+            if item is None or (uri := item.get("uri")) is None:
+                continue
+
+            if (resolved := self.lookahead.get(uri)) is None:
+                resolved = await self.prefetch_artwork(await self.resolve_item(item))
+
+            lookahead[uri] = resolved
+
+        self.lookahead = lookahead
+        await self.fetch_audio_features(
+            [self.current_track, *(item.get("id") for item in lookahead.values())]
+        )
+
+    async def fetch_audio_features(self, track_ids: list) -> None:
+        """Fetches the audio features of every track in `track_ids` that
+        isn't cached yet, up to `MAX_IDS_PER_REQUEST` per request
+
+        Tracks Spotify refuses (4xx) are cached as None so they aren't asked
+        for again, and a 403 turns audio features off for this connection
+        since Spotify no longer gives them to many apps at all
+
+        Args:
+            track_ids (list): Spotify track ids, local tracks have None
+        """
+        if not self.features_enabled:
             return
 
-        with open(LOCAL_ARTWORK_PATH, "wb") as img:
-            img.write(artwork)
+        missing = self.features.missing(track_ids)
+
+        for start in range(0, len(missing), MAX_IDS_PER_REQUEST):
+            batch = missing[start : start + MAX_IDS_PER_REQUEST]
+
+            try:
+                results = await self.call("audio_features", tracks=batch) or []
+            except SpotifyException as error:
+                logger.debug(f"Unable to fetch audio features: {error}")
+
+                if error.http_status == 403:
+                    logger.info("Audio features aren't available to this app")
+                    self.features_enabled = False
+
+                if 400 <= error.http_status < 500 and error.http_status != 429:
+                    for track_id in batch:
+                        self.features.put(track_id, None)
+                return
+            except (CircuitOpenError, RequestException) as error:
+                logger.debug(f"Unable to fetch audio features: {error}")
+                return
+
+            for track_id, features in zip(batch, results):
+                self.features.put(track_id, features)
 
-        return LOCAL_ARTWORK_PATH
+    def schedule_lookahead(self) -> None:
+        """Starts refreshing the lookahead unless a refresh is already running"""
+        if self.lookahead_task is None or self.lookahead_task.done():
+            self.lookahead_task = asyncio.create_task(self.refresh_lookahead())
+
+    async def resolve_track(self, track: dict) -> dict:
+        """Fills in `track["item"]` from the lookahead if it was pre-resolved,
+        otherwise resolves it now, and attaches the track's cached audio
+        features. Features that aren't cached yet are left as None rather
+        than holding up the event, the lookahead refresh started after it
+        fetches them
+
+        Args:
+            track (dict): The currently playing response from Spotify
+
+        Returns:
+            dict: `track` with its item resolved
+        """
+        item = track["item"]
+
+        if (resolved := self.lookahead.pop(item["uri"], None)) is not None:
+            track["item"] = resolved
+        else:
+            track["item"] = await self.resolve_item(item)
+
+        if track_id := item.get("id"):
+            track["audio_features"] = self.features.get(track_id)
+
+        return track
 
     async def check_now_playing(self, app) -> None:
         """Checks for current Spotify state and updates PolyPop in case of changes"""
-        if (spotify := self.spotify) is None:
+        if self.spotify is None:
             return
 
-        if (track := spotify.currently_playing()) is None:
+        if (track := await self.call("currently_playing")) is None:
             if self.is_playing:
-                await app.broadcast("playing_stopped")
+                await app.broadcast("playing_stopped", account=self.account)
 
             return
 
         if (track_data := track.get("item")) is None:
             return
 
+        self.current_context = (track.get("context") or {}).get("uri")
         track_id = track_data["id"]
         is_playing = track.get("is_playing", False)
 
         if self.is_playing is None:
             self.current_track = track_id
+            self.schedule_lookahead()
             return
 
         if is_playing != self.is_playing:
             self.is_playing = is_playing
 
             if not is_playing:
-                return await app.broadcast("playing_stopped")
+                return await app.broadcast("playing_stopped", account=self.account)
 
-            if track["item"]["is_local"] and (
-                local_artwork := self.get_local_artwork(
-                    track["item"]["uri"].split(":")[-2]
-                )
-            ):
-                track["item"]["album"]["images"] = [{"url": f"file/{local_artwork}"}]
-            await app.broadcast("started_playing", track)
+            await app.broadcast(
+                "started_playing", await self.resolve_track(track), self.account
+            )
 
         if self.current_track == track_id:
             return
 
-        if track["item"]["is_local"]:
-            if local_artwork := self.get_local_artwork(
-                track["item"]["uri"].split(":")[-2]
-            ):
-                track["item"]["album"]["images"] = [
-                    {"url": local_artwork.as_uri().replace("/", "\\")}
-                ]
-        await app.broadcast("song_changed", track)
+        await app.broadcast(
+            "song_changed", await self.resolve_track(track), self.account
+        )
 
         self.current_track = track_id
+        self.schedule_lookahead()
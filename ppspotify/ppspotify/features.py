@@ -0,0 +1,110 @@
+"""Cache of Spotify audio features (tempo, energy, key, ...) per track
+
+Audio features never change for a track, so once fetched they're kept in
+a bounded LRU cache that's saved to disk and shared by every account
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+
+from .store import JsonStore, read_json
+
+# Fields passed on to PolyPop, the rest of the response is dropped
+FEATURE_FIELDS = (
+    "tempo",
+    "energy",
+    "key",
+    "mode",
+    "danceability",
+    "valence",
+    "loudness",
+    "time_signature",
+)
+
+# Most track ids Spotify accepts in one audio features request
+MAX_IDS_PER_REQUEST = 100
+
+CACHE_SIZE = 5000
+
+# Seconds to wait for more tracks before saving the cache. Features can
+# always be fetched again, so there's no rush
+CACHE_FLUSH_DELAY = 30.0
+
+
+class AudioFeaturesCache(JsonStore):
+    """LRU cache of audio features keyed by track id
+
+    Tracks Spotify has no features for are cached as None so they aren't
+    requested again either
+
+    Args:
+        path (Path): The json file backing the cache
+        max_size (int, optional): Defaults to CACHE_SIZE.
+    """
+
+    __slots__ = "max_size", "entries"
+
+    def __init__(self, path: Path, max_size: int = CACHE_SIZE) -> None:
+        super().__init__(path, CACHE_FLUSH_DELAY)
+        self.max_size = max_size
+        self.entries: OrderedDict[str, dict | None] = OrderedDict()
+
+        if isinstance(stored := read_json(path), list):
+            for track_id, features in stored[-max_size:]:
+                self.entries[track_id] = features
+
+    def __contains__(self, track_id: str) -> bool:
+        return track_id in self.entries
+
+    def get(self, track_id: str) -> dict | None:
+        """Gets the features of a track and marks it as recently used
+
+        Args:
+            track_id (str)
+
+        Returns:
+            dict | None: None if unknown or Spotify has none for the track
+        """
+        if track_id not in self.entries:
+            return None
+
+        self.entries.move_to_end(track_id)
+        return self.entries[track_id]
+
+    def put(self, track_id: str, features: dict | None) -> None:
+        """Caches the features of a track, evicting the least recently used
+        track if the cache is full
+
+        Args:
+            track_id (str)
+            features (dict | None): An audio features object from Spotify
+        """
+        if features is not None:
+            features = {field: features.get(field) for field in FEATURE_FIELDS}
+
+        self.entries[track_id] = features
+        self.entries.move_to_end(track_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        self.mark_dirty()
+
+    def missing(self, track_ids: list[str]) -> list[str]:
+        """Filters `track_ids` down to the ones that still need fetching
+
+        Args:
+            track_ids (list[str])
+
+        Returns:
+            list[str]: Without duplicates, in their original order
+        """
+        return [
+            track_id
+            for track_id in dict.fromkeys(track_ids)
+            if track_id and track_id not in self.entries
+        ]
+
+    def snapshot(self) -> list[tuple[str, dict | None]]:
+        """Least recently used first, so reloading keeps the same order"""
+        return list(self.entries.items())
@@ -0,0 +1,403 @@
+"""Local index of the users Spotify library
+
+Keeps saved tracks, playlists and their tracks in a SQLite database with
+an FTS5 table on top, so PolyPop can search and play by name without a
+Spotify API call per query
+"""
+
+import sqlite3
+import threading
+
+from itertools import count
+from time import time
+from pathlib import Path
+
+from loguru import logger
+from spotipy import Spotify
+
+PAGE_SIZE = 50
+
+# Seconds between full syncs of the saved tracks. Incremental syncs only see
+# newly saved tracks, the full ones also notice tracks that were unsaved
+FULL_SYNC_INTERVAL = 6 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    uri TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    artists TEXT NOT NULL,
+    album TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS saved_tracks (
+    uri TEXT PRIMARY KEY,
+    added_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    uri TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_uri TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    track_uri TEXT NOT NULL,
+    PRIMARY KEY (playlist_uri, position)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5(
+    kind UNINDEXED, uri UNINDEXED, name, artists, album,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def build_match_query(query: str) -> str | None:
+    """Turns free text from PolyPop into a safe FTS5 prefix query
+
+    Args:
+        query (str): What the user typed, e.g. "daft punk one more"
+
+    Returns:
+        str | None: e.g. `"daft"* "punk"* "one"* "more"*` or None if empty
+    """
+    terms = [term.replace('"', '""') for term in query.split()]
+    if not terms:
+        return None
+
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+class LibraryIndex:
+    """SQLite backed index of saved tracks and playlists
+
+    Syncing is incremental: saved tracks stop at the newest `added_at` seen
+    on the previous sync and playlists are only re-fetched when their
+    `snapshot_id` changes. Every `FULL_SYNC_INTERVAL` all saved tracks are
+    fetched to catch unsaved ones, and tracks no longer saved or in any
+    playlist are dropped after every sync
+
+    Args:
+        path (Path): Location of the database file
+    """
+
+    __slots__ = "path", "connection", "lock"
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        """Closes the database connection"""
+        with self.lock:
+            self.connection.close()
+
+    def search(
+        self, query: str, kind: str | None = None, limit: int = 10
+    ) -> list[dict]:
+        """Searches the index by name, artist or album
+
+        Args:
+            query (str): Free text to look for
+            kind (str, optional): Only return "track" or "playlist" results
+            limit (int, optional): Max number of results. Defaults to 10.
+
+        Returns:
+            list[dict]: Best matches first
+        """
+        if (match := build_match_query(query)) is None:
+            return []
+
+        sql = (
+            "SELECT kind, uri, name, artists, album FROM library_fts "
+            "WHERE library_fts MATCH ?"
+        )
+        params: list = [match]
+
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+
+        # One weight per column, the unindexed kind and uri included
+        sql += " ORDER BY bm25(library_fts, 0, 0, 10.0, 5.0, 1.0) LIMIT ?"
+        params.append(limit)
+
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+
+        return [
+            {"kind": kind, "uri": uri, "name": name, "artists": artists, "album": album}
+            for kind, uri, name, artists, album in rows
+        ]
+
+    def upcoming(self, playlist_uri: str, track_uri: str, limit: int) -> list[str]:
+        """Gets the tracks that follow `track_uri` in an indexed playlist
+
+        Args:
+            playlist_uri (str)
+            track_uri (str): The track playing now
+            limit (int): Max number of tracks
+
+        Returns:
+            list[str]: Track uris in playlist order, empty if either isn't indexed
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT track_uri FROM playlist_tracks WHERE playlist_uri = ? "
+                "AND position > (SELECT MIN(position) FROM playlist_tracks "
+                "WHERE playlist_uri = ? AND track_uri = ?) ORDER BY position LIMIT ?",
+                (playlist_uri, playlist_uri, track_uri, limit),
+            ).fetchall()
+
+        return [uri for uri, in rows]
+
+    def sync(self, spotify: Spotify) -> None:
+        """Brings the index up to date with the users library.
+        Blocking, so run it in a worker thread
+
+        Args:
+            spotify (Spotify)
+        """
+        last_full_sync = float(self.get_watermark("full_sync") or 0)
+        full = time() - last_full_sync >= FULL_SYNC_INTERVAL
+
+        saved = self.sync_saved_tracks(spotify, full)
+        changed = self.sync_playlists(spotify)
+        pruned = self.prune()
+
+        if full:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO watermarks VALUES ('full_sync', ?)",
+                    (str(time()),),
+                )
+
+        logger.debug(
+            f"Library synced{' fully' if full else ''}: {saved} saved tracks, "
+            f"{changed} playlists, {pruned} tracks dropped"
+        )
+
+    def get_watermark(self, name: str) -> str | None:
+        """Gets the last synced value for `name`"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM watermarks WHERE name = ?", (name,)
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def upsert_tracks(self, tracks: list[dict]) -> None:
+        """Adds or updates tracks, must be called with the lock held and
+        inside a transaction
+
+        Args:
+            tracks (list[dict]): Track objects from Spotify
+        """
+        rows = [
+            (
+                track["uri"],
+                track.get("name") or "",
+                ", ".join(artist["name"] for artist in track.get("artists", [])),
+                (track.get("album") or {}).get("name") or "",
+            )
+            for track in tracks
+        ]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)", rows
+        )
+        self.connection.executemany(
+            "DELETE FROM library_fts WHERE kind = 'track' AND uri = ?",
+            [(row[0],) for row in rows],
+        )
+        self.connection.executemany(
+            "INSERT INTO library_fts VALUES ('track', ?, ?, ?, ?)", rows
+        )
+
+    def prune(self) -> int:
+        """Drops tracks that are neither saved nor in any indexed playlist,
+        so they can't be found by `search` anymore
+
+        Returns:
+            int: Number of tracks dropped
+        """
+        with self.lock, self.connection:
+            dropped = self.connection.execute(
+                "DELETE FROM tracks WHERE uri NOT IN (SELECT uri FROM saved_tracks) "
+                "AND uri NOT IN (SELECT track_uri FROM playlist_tracks)"
+            ).rowcount
+            self.connection.execute(
+                "DELETE FROM library_fts WHERE kind = 'track' "
+                "AND uri NOT IN (SELECT uri FROM tracks)"
+            )
+
+        return dropped
+
+    def sync_saved_tracks(self, spotify: Spotify, full: bool = False) -> int:
+        """Fetches saved tracks newer than the last sync
+
+        Args:
+            spotify (Spotify)
+            full (bool, optional): Fetch every saved track and forget the
+                ones that aren't saved anymore. Defaults to False.
+
+        Returns:
+            int: Number of saved tracks fetched
+        """
+        newest = stored = self.get_watermark("saved_tracks")
+        watermark = None if full else stored
+        seen: set[str] = set()
+        added = 0
+        counter = count(0, PAGE_SIZE)
+
+        while page := spotify.current_user_saved_tracks(
+            limit=PAGE_SIZE, offset=next(counter)
+        ):
+            fresh = [
+                item
+                for item in page.get("items", [])
+                if watermark is None or item["added_at"] > watermark
+            ]
+            items = [item for item in fresh if item.get("track")]
+
+            if items:
+                with self.lock, self.connection:
+                    self.upsert_tracks([item["track"] for item in items])
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO saved_tracks VALUES (?, ?)",
+                        [(item["track"]["uri"], item["added_at"]) for item in items],
+                    )
+
+                added += len(items)
+                seen.update(item["track"]["uri"] for item in items)
+
+            if fresh:
+                newest = max(newest or "", *(item["added_at"] for item in fresh))
+
+            # Saved tracks come newest first, so once we see an old one we're done
+            if len(fresh) < len(page.get("items", [])) or page.get("next") is None:
+                break
+
+        if newest != stored:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO watermarks VALUES ('saved_tracks', ?)",
+                    (newest,),
+                )
+
+        if full:
+            with self.lock:
+                known = {
+                    uri
+                    for uri, in self.connection.execute("SELECT uri FROM saved_tracks")
+                }
+
+            if unsaved := [(uri,) for uri in known - seen]:
+                with self.lock, self.connection:
+                    self.connection.executemany(
+                        "DELETE FROM saved_tracks WHERE uri = ?", unsaved
+                    )
+
+        return added
+
+    def sync_playlists(self, spotify: Spotify) -> int:
+        """Re-indexes every playlist whose `snapshot_id` changed and drops
+        playlists the user no longer has
+
+        Args:
+            spotify (Spotify)
+
+        Returns:
+            int: Number of playlists that were re-indexed
+        """
+        with self.lock:
+            known = dict(
+                self.connection.execute("SELECT uri, snapshot_id FROM playlists")
+            )
+
+        seen = set()
+        changed = 0
+        counter = count(0, PAGE_SIZE)
+
+        while page := spotify.current_user_playlists(
+            limit=PAGE_SIZE, offset=next(counter)
+        ):
+            for playlist in page.get("items", []):
+                seen.add(playlist["uri"])
+
+                if known.get(playlist["uri"]) == playlist["snapshot_id"]:
+                    continue
+
+                self.index_playlist(spotify, playlist)
+                changed += 1
+
+            if page.get("next") is None:
+                break
+
+        if removed := [(uri,) for uri in set(known) - seen]:
+            with self.lock, self.connection:
+                self.connection.executemany("DELETE FROM playlists WHERE uri = ?", removed)
+                self.connection.executemany(
+                    "DELETE FROM playlist_tracks WHERE playlist_uri = ?", removed
+                )
+                self.connection.executemany(
+                    "DELETE FROM library_fts WHERE kind = 'playlist' AND uri = ?",
+                    removed,
+                )
+
+        return changed
+
+    def index_playlist(self, spotify: Spotify, playlist: dict) -> None:
+        """Fetches all of a playlists tracks and replaces its entries
+
+        Args:
+            spotify (Spotify)
+            playlist (dict): Simplified playlist object from Spotify
+        """
+        tracks = []
+        counter = count(0, 100)
+
+        while page := spotify.playlist_items(
+            playlist["id"],
+            limit=100,
+            offset=next(counter),
+            fields="items(track(uri,name,artists(name),album(name))),next",
+            additional_types=("track",),
+        ):
+            tracks.extend(
+                item["track"]
+                for item in page.get("items", [])
+                if item.get("track") and item["track"].get("uri")
+            )
+            if page.get("next") is None:
+                break
+
+        uri = playlist["uri"]
+        owner = (playlist.get("owner") or {}).get("display_name") or ""
+
+        with self.lock, self.connection:
+            self.upsert_tracks(tracks)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?)",
+                (uri, playlist["id"], playlist["name"], playlist["snapshot_id"]),
+            )
+            self.connection.execute(
+                "DELETE FROM playlist_tracks WHERE playlist_uri = ?", (uri,)
+            )
+            self.connection.executemany(
+                "INSERT INTO playlist_tracks VALUES (?, ?, ?)",
+                [(uri, position, track["uri"]) for position, track in enumerate(tracks)],
+            )
+            self.connection.execute(
+                "DELETE FROM library_fts WHERE kind = 'playlist' AND uri = ?", (uri,)
+            )
+            self.connection.execute(
+                "INSERT INTO library_fts VALUES ('playlist', ?, ?, ?, '')",
+                (uri, playlist["name"], owner),
+            )
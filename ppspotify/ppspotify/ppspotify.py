@@ -11,9 +11,13 @@ Todo:
 
 
 from json import (
+    dumps as json_dumps,
     loads as json_loads,
 )  # Importing like this so there's one less lookup per request
+import asyncio
+import multiprocessing
 import sys
+from time import perf_counter
 from typing import Callable, cast
 
 from aiohttp import (
@@ -25,10 +29,20 @@ from aiohttp import (
 )
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from loguru import logger
+from requests.exceptions import RequestException
 from spotipy import Spotify
+from spotipy.exceptions import SpotifyException
 
+from .resilience import CircuitOpenError
 from .web_app import Server
-from .context import DIRECTORY_PATH, HOST, PORT
+from .context import (
+    DEFAULT_ACCOUNT,
+    DIRECTORY_PATH,
+    HOST,
+    PORT,
+    SpotifyContext,
+    is_valid_account,
+)
 
 
 # Create Logger
@@ -65,18 +79,24 @@ async def oauth_callback(request: web.Request) -> web.Response:
     logger.debug("Setting up Spotify connection")
 
     app = cast(Server, request.app)
-    payload = await app.context.create_spotify(
+    account = query.get("account", DEFAULT_ACCOUNT)
+
+    if not is_valid_account(account):
+        return web.Response(body="Invalid Account Name")
+
+    context = app.get_context(account)
+    payload = await context.create_spotify(
         app, client_id=query["client-id"], client_secret=query["client-secret"]
     )
 
     logger.debug("Spotify connection setup")
 
-    spotify = cast(Spotify, app.context.spotify)
+    spotify = cast(Spotify, context.spotify)
 
     if payload is None or spotify is None:
         return web.Response(body="Authorization Error")
 
-    await app.broadcast(*payload)
+    await app.broadcast(*payload, account=account)
     me = spotify.me()
 
     if me is None:
@@ -94,50 +114,78 @@ async def oauth_callback(request: web.Request) -> web.Response:
 async def websocket_handler(request: web.Request) -> web.Response:
     """Handles messages from websocket connections
 
+    Clients are subscribed to the account given by `?account=`, or
+    `DEFAULT_ACCOUNT` if there isn't one, until they send a `subscribe`
+
     Args:
         app (Server)
         request (web.Request)
     """
-    websocket = web.WebSocketResponse()
-    await websocket.prepare(request)
+    if not is_valid_account(account := request.query.get("account", DEFAULT_ACCOUNT)):
+        raise web.HTTPBadRequest(text="Invalid Account Name")
 
     app = cast(Server, request.app)
-    app.clients.add(websocket)
-
-    logger.info(f"Websocket connection established.")
-
-    logger.debug("Creating Spotify connection")
-    if (payload := await app.context.create_spotify(app)) is not None:
-        await app.broadcast(*payload)
-
-    async for payload in websocket:
-        match payload.type:
-            case WSMsgType.TEXT:
-                try:
-                    data = json_loads(payload.data)
-                    if not isinstance(data, (list, tuple)):
-                        raise ValueError
-                except ValueError:
+
+    websocket = app.create_websocket()
+    await websocket.prepare(request)
+    context = app.subscribe(websocket, account)
+
+    logger.info(f"Websocket connection established for {account}.")
+
+    try:
+        logger.debug("Creating Spotify connection")
+        try:
+            await connect_context(app, context, request.query.get("stream") == "1")
+        except (
+            CircuitOpenError,
+            SpotifyException,
+            RequestException,
+            RuntimeError,
+        ) as error:
+            # Keep the client, it can still log in or subscribe again
+            logger.warning(f"Unable to connect {account} to Spotify: {error}")
+
+        async for payload in websocket:
+            match payload.type:
+                case WSMsgType.TEXT:
+                    try:
+                        data = json_loads(payload.data)
+                        if not isinstance(data, (list, tuple)):
+                            raise ValueError
+                    except ValueError:
+                        logger.warning(
+                            "Failed to load message from websocket. "
+                            f"Contents:\n{payload}"
+                        )
+                        continue
+
+                    if app.recorder is not None:
+                        app.recorder.command(app.clients.get(websocket, account), data)
+
+                    try:
+                        await handle_actions(app, data, websocket)
+                    except WSServerHandshakeError:
+                        logger.warning("Error connecting to websocket")
+                    except ConnectionResetError:
+                        logger.warning("Websocket connection reset")
+                    except WebSocketError as error:
+                        logger.exception(error)
+                    except (
+                        CircuitOpenError,
+                        SpotifyException,
+                        RequestException,
+                        RuntimeError,
+                    ) as error:
+                        logger.warning(f"Spotify request failed: {error}")
+
+                case WSMsgType.ERROR:
                     logger.warning(
-                        f"Failed to load message from websocket. Contents:\n{payload}"
+                        f"Connection closed unexpectedly {websocket.exception()}"
                     )
-                    continue
-
-                try:
-                    await handle_actions(app, data)
-                except WSServerHandshakeError:
-                    logger.warning("Error connecting to websocket")
-                except ConnectionResetError:
-                    logger.warning("Websocket connection reset")
-                except WebSocketError as error:
-                    logger.exception(error)
-
-            case WSMsgType.ERROR:
-                logger.warning(
-                    f"Connection closed unexpectedly {websocket.exception()}"
-                )
+    finally:
+        # Whatever ended the connection, its account mustn't keep polling
+        app.unsubscribe(websocket)
 
-    app.clients.remove(websocket)
     logger.warning(f"Client {request.url} connection closed")
 
     return web.Response(body="Websocket Closed")
@@ -160,59 +208,192 @@ async def startup(
     Returns:
         web.Response: Rendered page
     """
+    account = request.query.get("account", DEFAULT_ACCOUNT)
+
+    if not is_valid_account(account):
+        raise web.HTTPBadRequest(text="Invalid Account Name")
+
     return web.Response(
-        body=jinja_env.get_template("setup.html").render(),
+        body=jinja_env.get_template("setup.html").render(account=account),
         content_type="text/html",
     )
 
 
-async def handle_actions(app: Server, payload: list | tuple) -> None:
+async def connect_context(
+    app: Server,
+    context: SpotifyContext,
+    stream_playlists: bool = False,
+    spotify: Spotify | None = None,
+) -> None:
+    """Connects `context` to Spotify and sends `spotify_connect` to its clients
+
+    Args:
+        app (Server): Currently running server
+        context (SpotifyContext): Context of the account to connect
+        stream_playlists (bool, optional): Send the playlists afterwards as
+            `playlists_chunk` messages instead of inside `spotify_connect`.
+            Defaults to False.
+        spotify (Spotify, optional): See `SpotifyContext.create_spotify`
+    """
+    if app.recorder is not None:
+        app.recorder.connect(context.account, stream_playlists)
+
+    if (
+        payload := await context.create_spotify(
+            app, stream_playlists=stream_playlists, spotify=spotify
+        )
+    ) is None:
+        return
+
+    await app.broadcast(*payload, account=context.account)
+
+    if stream_playlists:
+        context.tasks.append(asyncio.create_task(stream_in_background(app, context)))
+
+
+async def stream_in_background(app: Server, context: SpotifyContext) -> None:
+    """Streams the playlists after `spotify_connect`. Nothing awaits this
+    task, so failures are logged here instead of being lost with it
+
+    Args:
+        app (Server): Currently running server
+        context (SpotifyContext): Context of the account that just connected
+    """
+    try:
+        await context.stream_playlists(app)
+    except (CircuitOpenError, SpotifyException, RequestException) as error:
+        logger.warning(f"Streaming playlists for {context.account} failed: {error}")
+
+
+async def handle_actions(
+    app: Server, payload: list | tuple, websocket: web.WebSocketResponse | None = None
+) -> None:
     """Performs the actions sent to the websocket service
 
+    A frame is either a single action, `["play", {...}]`, or a batch of
+    actions, `["batch", [{"id": 1, "action": "play", "data": {...}}, ...]]`.
+    Batches get a single `batch_result` reply sent back to `websocket`.
+    Actions run against the account `websocket` is subscribed to, which
+    can be changed with `["subscribe", {"account": ...}]`. Subscribing to the
+    account the client is already on does nothing while it's connected
+
     Args:
         app (Server): Currently running server. Should not change
-        data (dict): The data sent from the websocket service.
+        payload (list | tuple): The data sent from the websocket service.
+        websocket (web.WebSocketResponse, optional): The client that sent the frame
+    """
+    context = app.context_for(websocket)
+
+    match payload:
+        case [
+            "subscribe",
+            {"account": str() as account} as data,
+        ] if websocket is not None:
+            if not is_valid_account(account):
+                logger.warning(f"Client tried subscribing to invalid account {account}")
+                return
+
+            if app.clients.get(websocket) == account and context.spotify is not None:
+                return
+
+            context = app.subscribe(websocket, account)
+            await connect_context(app, context, bool(data.get("stream")))
+            return
+
+        case ["batch", list() as commands]:
+            result = await run_batch(app, context, commands)
+
+            if websocket is None:
+                return
+
+            message = json_dumps({"action": "batch_result", "data": result})
+
+            if app.recorder is not None:
+                app.recorder.sent(context.account, "batch_result", len(message))
+
+            try:
+                await app.send(websocket, message)
+            except ConnectionResetError:
+                logger.warning("Connection reset.")
+            return
+
+    try:
+        response = await run_action(app, context, payload)
+    except UnknownActionError as error:
+        logger.debug(f"Websocket received unknown information: {error}")
+        return
+
+    if response is not None:
+        await app.broadcast(*response, account=context.account)
+
+
+# Actions that change the player, a batch runs these one after the other in
+# the order they were sent instead of alongside everything else
+ORDERED_ACTIONS = frozenset(
+    {"play", "search_play", "pause", "next", "previous", "update", "logout", "quit"}
+)
+
+
+class UnknownActionError(Exception):
+    """Raised by `run_action` for actions the service doesn't know about"""
+
+
+async def run_action(
+    app: Server, context: SpotifyContext, payload: list | tuple
+) -> tuple | None:
+    """Runs a single action and returns the response to send back, if any
+
+    Args:
+        app (Server): Currently running server
+        context (SpotifyContext): Context of the account to run the action for
+        payload (list | tuple): The action name followed by its data
+
+    Raises:
+        UnknownActionError: The action isn't one the service knows about
+
+    Returns:
+        tuple | None: `(action, data)` to send to PolyPop
     """
     match payload:
 
         case ["login", *_]:
-            response = app.context.request_credentials_from_user()
+            return context.request_credentials_from_user()
 
         case ["logout", *_]:
-            response = app.context.logout()
+            return context.logout()
 
         case ["play", data]:
-            response = await app.context.play(data)
+            return await context.play(data)
 
         case ["refresh_devices", *_]:
-            response = await app.context.refresh_devices()
+            return await context.refresh_devices()
+
+        case ["refresh_playlists", {"stream": True}]:
+            return await context.stream_playlists(app)
 
         case ["refresh_playlists", *_]:
-            response = await app.context.refresh_playlists()
+            return await context.refresh_playlists()
 
         case ["pause", *_]:
-            if app.context.spotify is None:
-                return
-
-            response = app.context.spotify.pause_playback()
+            return await context.call("pause_playback")
 
         case ["next", *_]:
-            if app.context.spotify is None:
-                return
-
-            response = app.context.spotify.next_track()
+            return await context.call("next_track")
 
         case ["previous", *_]:
-            if app.context.spotify is None:
-                return
-
-            response = app.context.spotify.previous_track()
+            return await context.call("previous_track")
 
         case ["get_devices", *_]:
-            response = app.context.get_devices()
+            return await context.refresh_devices()
 
         case ["update", data]:
-            response = await app.context.update_settings(data)
+            return await context.update_settings(data)
+
+        case ["search", data]:
+            return await context.search(data)
+
+        case ["search_play", data]:
+            return await context.search_play(data)
 
         case ["quit", *_]:
             for client in app.clients:
@@ -220,11 +401,96 @@ async def handle_actions(app: Server, payload: list | tuple) -> None:
             sys.exit()
 
         case _:
-            logger.debug("Websocket received unknown information: {_}")
-            return
+            raise UnknownActionError(payload)
 
-    if response is not None:
-        await app.broadcast(*response)
+
+async def run_batch(app: Server, context: SpotifyContext, commands: list) -> dict:
+    """Runs a batch of commands concurrently and collects their results
+
+    Commands that change the player (`ORDERED_ACTIONS`) run one at a time in
+    the order they were sent, so e.g. `next`, `next` skips two tracks and
+    `play` happens before the `update` after it. The rest run concurrently
+    alongside them. Every command gets its own entry in the results, in the
+    same order they were sent, so the client can match them up by `id`
+
+    Args:
+        app (Server): Currently running server
+        context (SpotifyContext): Context of the account to run the commands for
+        commands (list): Commands in the form of `{"id": ..., "action": ..., "data": ...}`
+
+    Returns:
+        dict: `{"results": [...], "elapsed_ms": float}`
+    """
+    batch_start = perf_counter()
+
+    async def run_command(command: dict) -> dict:
+        start = perf_counter()
+
+        if not isinstance(command, dict) or "action" not in command:
+            return {
+                "id": None,
+                "status": "error",
+                "error": f"Malformed command: {command}",
+                "elapsed_ms": 0.0,
+            }
+
+        result = {"id": command.get("id"), "action": command["action"]}
+        payload = [command["action"]]
+
+        if "data" in command:
+            payload.append(command["data"])
+
+        try:
+            response = await run_action(app, context, payload)
+        except UnknownActionError:
+            result.update(status="error", error=f"Unknown action: {payload[0]}")
+        except SpotifyException as error:
+            result.update(status="error", error=error.msg)
+        except (CircuitOpenError, RequestException) as error:
+            result.update(status="error", error=str(error))
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception(error)
+            result.update(status="error", error=str(error))
+        else:
+            result["status"] = "ok"
+            if isinstance(response, tuple):
+                action, *data = response
+                result["response"] = {
+                    "action": action,
+                    "data": data[0] if data else None,
+                }
+
+                if action == "error":
+                    # e.g. `play` reports failing on every device this way
+                    result.update(status="error", error=data[0].get("msg"))
+
+        result["elapsed_ms"] = round((perf_counter() - start) * 1000, 3)
+        return result
+
+    ordered, concurrent = [], []
+    for index, command in enumerate(commands):
+        if isinstance(command, dict) and command.get("action") in ORDERED_ACTIONS:
+            ordered.append(index)
+        else:
+            concurrent.append(index)
+
+    async def run_in_order() -> list[dict]:
+        return [await run_command(commands[index]) for index in ordered]
+
+    ordered_results, *concurrent_results = await asyncio.gather(
+        run_in_order(), *(run_command(commands[index]) for index in concurrent)
+    )
+
+    results: list[dict] = [{}] * len(commands)
+    for index, result in zip(
+        ordered + concurrent, ordered_results + concurrent_results
+    ):
+        results[index] = result
+
+    return {
+        "results": results,
+        "elapsed_ms": round((perf_counter() - batch_start) * 1000, 3),
+    }
 
 
 @web.middleware
@@ -260,10 +526,14 @@ async def cleanup_context(app: Server) -> None:
     Args:
         app (Server): Used for Application Context
     """
-    app.context.close()
+    for context in app.contexts.values():
+        context.close()
 
 
 def main() -> None:  # pylint: disable=missing-function-docstring
+    # The artwork process pool re-runs this executable when frozen
+    multiprocessing.freeze_support()
+
     app = Server(middlewares=[error_middleware])
     app.add_routes(routes)
     app.on_cleanup.append(cleanup_context)  # type: ignore
@@ -0,0 +1,124 @@
+"""Circuit breakers and backoff used around outbound Spotify calls
+
+When an endpoint keeps failing its breaker opens and calls to it fail
+fast with `CircuitOpenError` instead of hitting Spotify. After a jittered,
+growing cool down one probe call is let through; if it succeeds the
+breaker closes again
+"""
+
+import random
+
+from time import monotonic
+
+# Consecutive failed calls before a breaker opens
+FAILURE_THRESHOLD = 5
+
+# Retries of a single call on 5xx responses or network errors
+MAX_RETRIES = 3
+
+# Seconds, for retry backoff and for how long a breaker stays open
+BACKOFF_BASE, BACKOFF_CAP = 0.5, 8.0
+OPEN_BASE, OPEN_CAP = 5.0, 300.0
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+def backoff_delay(
+    attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP
+) -> float:
+    """Exponential backoff with full jitter
+
+    Args:
+        attempt (int): 0 for the first retry, 1 for the second, ...
+        base (float, optional): Defaults to BACKOFF_BASE.
+        cap (float, optional): Defaults to BACKOFF_CAP.
+
+    Returns:
+        float: Seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose breaker is open
+
+    Args:
+        endpoint (str): The endpoint that's failing
+        retry_in (float): Seconds until a probe call will be let through
+    """
+
+    def __init__(self, endpoint: str, retry_in: float) -> None:
+        super().__init__(f"{endpoint} is unavailable, retrying in {retry_in:.1f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Tracks the health of a single endpoint
+
+    Args:
+        endpoint (str): Name of the endpoint, e.g. "currently_playing"
+    """
+
+    __slots__ = "endpoint", "state", "failures", "trips", "opened_at", "open_for"
+
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self.open_for = 0.0
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until the breaker lets a probe call through"""
+        return max(0.0, self.opened_at + self.open_for - monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may go out right now. Moves an open breaker whose
+        cool down has passed to half open and lets exactly one call through
+
+        Returns:
+            bool
+        """
+        if self.state == CLOSED:
+            return True
+
+        if self.state == OPEN and self.retry_in == 0:
+            self.state = HALF_OPEN
+            return True
+
+        return False
+
+    def record_success(self) -> bool:
+        """Closes the breaker
+
+        Returns:
+            bool: True if the breaker wasn't already closed
+        """
+        changed = self.state != CLOSED
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        return changed
+
+    def record_failure(self) -> bool:
+        """Counts a failed call, opening the breaker if there were too many
+
+        Returns:
+            bool: True if the breaker just opened
+        """
+        self.failures += 1
+
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.failures >= FAILURE_THRESHOLD
+        ):
+            changed = self.state == CLOSED
+            self.state = OPEN
+            self.opened_at = monotonic()
+            self.open_for = backoff_delay(self.trips, OPEN_BASE, OPEN_CAP) + OPEN_BASE
+            self.trips += 1
+            return changed
+
+        return False
@@ -0,0 +1,275 @@
+"""Shared scheduler for outbound Spotify API calls
+
+Every account hosted by the `Server` sends its requests through the same
+`Scheduler` so they share one connection pool, back off together when
+Spotify starts rate limiting the app and stop calling endpoints that are
+down
+"""
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import count
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from spotipy.exceptions import SpotifyException
+
+from .resilience import (
+    CLOSED,
+    HALF_OPEN,
+    MAX_RETRIES,
+    CircuitBreaker,
+    CircuitOpenError,
+    backoff_delay,
+)
+
+# Max number of Spotify requests in flight across all accounts
+MAX_CONCURRENT_REQUESTS = 8
+
+# Threads for blocking jobs that call Spotify through a `ScheduledClient`,
+# like library syncs. Those wait on calls that need a default executor thread,
+# so they get threads of their own instead of taking the default ones
+MAX_JOBS = 2
+
+# Used when Spotify rate limits us without saying for how long
+DEFAULT_RETRY_AFTER = 1.0
+
+# Calls that change the player. A 5xx or network error doesn't say whether
+# they went through, so they're never repeated, e.g. one press of next
+# could otherwise skip two tracks. 429s are still retried, those never ran
+WRITE_ENDPOINTS = frozenset(
+    {
+        "start_playback",
+        "pause_playback",
+        "next_track",
+        "previous_track",
+        "volume",
+        "shuffle",
+        "repeat",
+        "add_to_queue",
+    }
+)
+
+
+def create_session(pool_size: int = MAX_CONCURRENT_REQUESTS) -> Session:
+    """Creates the `requests.Session` shared by every Spotify connection.
+    The adapter doesn't retry anything itself, `Scheduler.run` does
+
+    Args:
+        pool_size (int, optional): Connections kept alive per host.
+            Defaults to MAX_CONCURRENT_REQUESTS.
+
+    Returns:
+        Session
+    """
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class SharedSession(Session):
+    """Session for a single `Spotify` connection that sends its requests
+    through the connection pools of the session every account shares.
+    Spotipy closes its session once the `Spotify` object is deleted, which
+    would drop every account's kept alive connections, so closing this one
+    leaves them open. The shared session is closed by the `Server`
+
+    Args:
+        session (Session): The shared session
+    """
+
+    def __init__(self, session: Session) -> None:
+        super().__init__()
+        self.adapters = session.adapters
+
+    def close(self) -> None:
+        """Does nothing, the pools belong to the shared session"""
+
+
+class Scheduler:
+    """Runs blocking Spotipy calls in worker threads
+
+    Limits how many calls are in flight at once and, when Spotify answers
+    with a 429, holds every call back until its `Retry-After` has passed.
+    5xx responses and network errors are retried with jittered exponential
+    backoff, apart from `WRITE_ENDPOINTS`, and counted against a per
+    endpoint `CircuitBreaker`
+
+    Blocking jobs that make calls of their own through a `ScheduledClient`
+    run in a separate pool of `MAX_JOBS` threads, see `run_job`
+
+    Args:
+        max_concurrent (int, optional): Defaults to MAX_CONCURRENT_REQUESTS.
+    """
+
+    __slots__ = "semaphore", "resume_at", "breakers", "on_state_change", "jobs"
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_REQUESTS) -> None:
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.resume_at = 0.0
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.on_state_change: Callable[[dict], Awaitable[None]] | None = None
+        self.jobs: ThreadPoolExecutor | None = None
+
+    @property
+    def status(self) -> dict:
+        """Whether any endpoint is currently failing, and which ones
+
+        Returns:
+            dict: {"degraded": bool, "endpoints": [...]}
+        """
+        failing = [
+            endpoint
+            for endpoint, breaker in self.breakers.items()
+            if breaker.state != CLOSED
+        ]
+        return {"degraded": bool(failing), "endpoints": failing}
+
+    async def run_job(self, func: Callable, *args) -> Any:
+        """Runs blocking `func` in one of the scheduler's job threads. Meant
+        for code that calls Spotify through a `ScheduledClient`, which blocks
+        its thread until the call has run in the default executor. In the
+        default executor a few of those at once could take every thread and
+        leave none for the calls they're waiting on
+
+        Args:
+            func (Callable)
+
+        Returns:
+            Any: Whatever `func` returns
+        """
+        if self.jobs is None:
+            self.jobs = ThreadPoolExecutor(MAX_JOBS, thread_name_prefix="job")
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.jobs, partial(func, *args)
+        )
+
+    def close(self) -> None:
+        """Stops the job threads, cancelling jobs that haven't started"""
+        if self.jobs is not None:
+            self.jobs.shutdown(wait=False, cancel_futures=True)
+            self.jobs = None
+
+    async def notify(self) -> None:
+        """Tells `on_state_change` that a breaker opened or closed"""
+        if self.on_state_change is not None:
+            await self.on_state_change(self.status)
+
+    async def wait_for_rate_limit(self) -> None:
+        """Sleeps until the last `Retry-After` given by Spotify has passed"""
+        while (delay := self.resume_at - monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self, endpoint: str, func: Callable, *args, **kwargs) -> Any:
+        """Runs `func` in a worker thread once there's room for it
+
+        Args:
+            endpoint (str): Name used to track the health of what `func` calls
+            func (Callable): Blocking Spotipy method to call
+
+        Raises:
+            CircuitOpenError: `endpoint` has been failing, so it wasn't called
+            SpotifyException: Passed through from Spotipy
+            RequestException: Network errors that outlasted the retries
+
+        Returns:
+            Any: Whatever `func` returns
+        """
+        if (breaker := self.breakers.get(endpoint)) is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(endpoint)
+
+        if not breaker.allow():
+            raise CircuitOpenError(endpoint, breaker.retry_in)
+
+        for attempt in count():
+            await self.wait_for_rate_limit()
+
+            try:
+                async with self.semaphore:
+                    result = await asyncio.to_thread(func, *args, **kwargs)
+
+            except SpotifyException as error:
+                if error.http_status == 429:
+                    retry_after = (error.headers or {}).get("Retry-After")
+                    delay = float(retry_after or DEFAULT_RETRY_AFTER)
+                    self.resume_at = max(self.resume_at, monotonic() + delay)
+                    logger.warning(f"Rate limited by Spotify for {delay}s")
+
+                    if attempt < MAX_RETRIES:
+                        continue
+
+                if error.http_status < 500:
+                    # Spotify answered, so the endpoint itself is fine
+                    if breaker.record_success():
+                        await self.notify()
+                    raise
+
+                failure = error
+
+            except RequestException as error:
+                failure = error
+
+            except (asyncio.CancelledError, Exception):
+                # Anything else still has to end a probe, otherwise the
+                # breaker stays half open and rejects every call from now on
+                if breaker.state == HALF_OPEN and breaker.record_failure():
+                    await self.notify()
+                raise
+
+            else:
+                if breaker.record_success():
+                    logger.info(f"{endpoint} recovered")
+                    await self.notify()
+                return result
+
+            if (
+                attempt >= MAX_RETRIES
+                or breaker.state == HALF_OPEN
+                or endpoint in WRITE_ENDPOINTS
+            ):
+                if breaker.record_failure():
+                    logger.warning(f"{endpoint} keeps failing, backing off")
+                    await self.notify()
+                raise failure
+
+            await asyncio.sleep(backoff_delay(attempt))
+
+
+class ScheduledClient:
+    """Lets blocking code in a worker thread, like `LibraryIndex.sync`, call
+    Spotipy through the `Scheduler` running on the event loop, so each of
+    its calls gets the breakers, backoff and rate limiting of its own
+
+    Args:
+        client (Spotify): Client whose methods are called
+        scheduler (Scheduler)
+        loop (asyncio.AbstractEventLoop): Loop `scheduler` runs on
+    """
+
+    __slots__ = "client", "scheduler", "loop"
+
+    def __init__(
+        self, client: Any, scheduler: Scheduler, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self.client = client
+        self.scheduler = scheduler
+        self.loop = loop
+
+    def __getattr__(self, method: str) -> Callable:
+        func = getattr(self.client, method)
+
+        def scheduled(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(
+                self.scheduler.run(method, func, *args, **kwargs), self.loop
+            ).result()
+
+        return scheduled
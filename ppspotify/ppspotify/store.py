@@ -0,0 +1,219 @@
+"""Small persistent stores for settings and other state kept on disk
+
+Files are always replaced atomically, so a crash mid-write can never leave
+PolyPop or the service reading half of a file
+"""
+
+import asyncio
+import os
+import threading
+
+from abc import ABC, abstractmethod
+from json import dumps as json_dumps, loads as json_loads, JSONDecodeError
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any
+
+from loguru import logger
+
+# Seconds to wait for more changes before writing a store to disk
+FLUSH_DELAY = 1.0
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Writes `data` to a temp file next to `path` then renames it over `path`
+
+    Args:
+        path (Path): File to replace
+        data (bytes): New contents
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    ) as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+
+    try:
+        os.replace(temp_file.name, path)
+    except OSError:
+        Path(temp_file.name).unlink(True)
+        raise
+
+
+def read_json(path: Path) -> Any:
+    """Reads a json file, treating a missing or corrupt file as empty
+
+    Args:
+        path (Path)
+
+    Returns:
+        Any: The decoded contents or None
+    """
+    try:
+        return json_loads(path.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (JSONDecodeError, UnicodeDecodeError):
+        logger.warning(f"Ignoring corrupt file {path}")
+        return None
+
+
+class JsonStore(ABC):
+    """Base for state kept in memory and written to a json file
+
+    Changes only mark the store as dirty; the write happens `flush_delay`
+    seconds later so several changes in a row cost a single write. Those
+    writes are encoded and saved in a worker thread so big stores don't
+    stall the event loop. `flush` writes right away, e.g. on shutdown
+
+    Subclasses implement `snapshot`
+
+    Args:
+        path (Path): The json file backing the store
+        flush_delay (float, optional): Defaults to FLUSH_DELAY.
+    """
+
+    __slots__ = (
+        "path",
+        "flush_delay",
+        "dirty",
+        "flush_handle",
+        "version",
+        "written",
+        "lock",
+    )
+
+    def __init__(self, path: Path, flush_delay: float = FLUSH_DELAY) -> None:
+        self.path = path
+        self.flush_delay = flush_delay
+        self.dirty = False
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.version = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def snapshot(self) -> Any:
+        """Copies the state to write, taken on the event loop so the worker
+        thread never sees it change mid-write
+
+        Returns:
+            Any: Json serializable
+        """
+
+    def mark_dirty(self) -> None:
+        """Records a change and schedules a write for it"""
+        self.dirty = True
+        self.version += 1
+        self.schedule_flush()
+
+    def schedule_flush(self) -> None:
+        """Writes the store after `flush_delay`, or right away when there's
+        no event loop to wait on"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.flush()
+
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_later(
+                self.flush_delay, self.flush_in_background, loop
+            )
+
+    def flush_in_background(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Hands the current state to a worker thread to write"""
+        self.flush_handle = None
+
+        if self.dirty:
+            self.dirty = False
+            loop.run_in_executor(
+                None, self.write, self.snapshot(), self.version
+            ).add_done_callback(self.log_write_error)
+
+    def log_write_error(self, future: asyncio.Future) -> None:
+        """Logs whatever a background write raised that `write` doesn't
+        handle itself, like values that aren't json serializable"""
+        if not future.cancelled() and (error := future.exception()) is not None:
+            logger.opt(exception=error).error(f"Unable to save {self.path}")
+
+    def flush(self) -> None:
+        """Writes the store to disk if anything changed since the last write"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.dirty:
+            self.dirty = False
+            self.write(self.snapshot(), self.version)
+
+    def write(self, snapshot: Any, version: int) -> None:
+        """Writes `snapshot` unless a newer one was already written, which
+        can happen when a background write finishes after `flush`
+
+        Args:
+            snapshot (Any): From `snapshot`
+            version (int): `version` when the snapshot was taken
+        """
+        with self.lock:
+            if version <= self.written:
+                return
+
+            try:
+                write_atomic(self.path, json_dumps(snapshot).encode())
+            except OSError as error:
+                logger.warning(f"Unable to save {self.path}: {error}")
+                return
+
+            self.written = version
+
+
+class ConfigStore(JsonStore):
+    """Key/value settings kept in memory and written to a json file
+
+    Setting a value to what it already is costs nothing, see `JsonStore`
+    for when changes are written
+
+    Args:
+        path (Path): The json file backing the store
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.data: dict[str, Any] = {}
+
+        if isinstance(stored := read_json(path), dict):
+            self.data = stored
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Gets a setting
+
+        Args:
+            key (str)
+            default (Any, optional): Returned if `key` isn't set. Defaults to None.
+
+        Returns:
+            Any
+        """
+        return self.data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """Changes a setting and schedules a write if it actually changed
+
+        Args:
+            key (str)
+            value (Any): Must be json serializable
+        """
+        if key in self.data and self.data[key] == value:
+            return
+
+        self.data[key] = value
+        self.mark_dirty()
+
+    def snapshot(self) -> dict[str, Any]:
+        """Shallow copy of the settings"""
+        return dict(self.data)
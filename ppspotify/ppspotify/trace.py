@@ -0,0 +1,458 @@
+"""Record and replay of Spotify traffic for repeatable performance runs
+
+In capture mode every Spotipy call (its arguments, result or error and how
+long it took), every websocket command and every message sent to PolyPop
+is appended to a gzipped json lines trace. Anything identifying the user
+is swapped for a pseudonym before it's written, so traces can be shared.
+
+During replay `ReplaySpotify` stands in for `Spotify`, answering each call
+with what Spotify answered at the same point of the recorded session
+"""
+
+import gzip
+import hmac
+import re
+import threading
+import time
+
+from bisect import bisect_right
+from collections import Counter
+from json import dumps as json_dumps, loads as json_loads
+from pathlib import Path
+from secrets import token_bytes
+from typing import Any, Callable
+
+from loguru import logger
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import RequestException
+from spotipy import Spotify
+from spotipy.exceptions import SpotifyException
+
+TRACE_VERSION = 1
+
+# Record kinds, each record is `[ms since capture started, kind, account, ...]`
+API, COMMAND, CONNECT, SENT = "api", "command", "connect", "sent"
+
+# Values of these keys are always pseudonymised
+PRIVATE_KEYS = frozenset(
+    {
+        "display_name",
+        "email",
+        "birthdate",
+        "country",
+        "device_id",
+        "device_name",
+        "local_media_folder",
+        "client_id",
+        "client_secret",
+    }
+)
+
+# Strings that point at a user, e.g. `spotify:user:...` or `.../v1/users/...`
+USER_REFERENCE = re.compile(r"spotify:user:|/users/")
+
+# URLs in Spotipy's error messages. Their queries can hold ids like `device_id`
+URL = re.compile(r"(https?://[^\s?]+)(\?\S*?)?(?=:?(?:\s|$))")
+
+
+class Pseudonymizer:
+    """Replaces personal values with stable pseudonyms
+
+    The same value always gets the same pseudonym within a trace, so a
+    device name sent by PolyPop still matches the device list from Spotify
+    on replay. The key is random and never written anywhere
+    """
+
+    __slots__ = ("key",)
+
+    def __init__(self) -> None:
+        self.key = token_bytes(16)
+
+    def pseudonym(self, value: str) -> str:
+        """Gets the pseudonym for `value`
+
+        Args:
+            value (str)
+
+        Returns:
+            str: e.g. "anon-3f2a9c1b7d04"
+        """
+        digest = hmac.new(self.key, value.encode(), "sha256").hexdigest()
+        return f"anon-{digest[:12]}"
+
+    def scrub(self, value: Any, private: bool = False) -> Any:
+        """Copies a json compatible value with every personal string replaced
+
+        User objects and devices are private as a whole, apart from their
+        `type`; everywhere else only `PRIVATE_KEYS` and user references are
+
+        Args:
+            value (Any)
+            private (bool, optional): Pseudonymise every string in `value`.
+                Defaults to False.
+
+        Returns:
+            Any
+        """
+        if isinstance(value, str):
+            if private or USER_REFERENCE.search(value):
+                return self.pseudonym(value)
+            return value
+
+        if isinstance(value, dict):
+            private = (
+                private or value.get("type") == "user" or "volume_percent" in value
+            )
+            return {
+                key: item
+                if key == "type"
+                else self.scrub(item, private or key in PRIVATE_KEYS)
+                for key, item in value.items()
+            }
+
+        if isinstance(value, (list, tuple)):
+            return [self.scrub(item, private) for item in value]
+
+        return value
+
+
+def scrub_url(match: re.Match) -> str:
+    """Drops the query of a URL matched by `URL`, and the whole URL when it
+    points at a user
+
+    Args:
+        match (re.Match)
+
+    Returns:
+        str
+    """
+    url = match.group(1)
+    return "(user url)" if USER_REFERENCE.search(url) else url
+
+
+def describe_error(error: Exception) -> dict:
+    """Turns an error raised by Spotipy into something that can be raised
+    again on replay, without the ids in the URL of the failed request
+
+    Args:
+        error (Exception): A `SpotifyException` or `RequestException`
+
+    Returns:
+        dict
+    """
+    if isinstance(error, SpotifyException):
+        return {
+            "status": error.http_status,
+            "code": error.code,
+            "msg": URL.sub(scrub_url, error.msg),
+            "reason": error.reason,
+            "retry_after": (error.headers or {}).get("Retry-After"),
+        }
+
+    return {"network": type(error).__name__}
+
+
+def rebuild_error(error: dict) -> Exception:
+    """Inverse of `describe_error`
+
+    Args:
+        error (dict)
+
+    Returns:
+        Exception
+    """
+    if "network" in error:
+        return RequestsConnectionError(error["network"])
+
+    return SpotifyException(
+        error["status"],
+        error["code"],
+        error["msg"],
+        error["reason"],
+        headers={"Retry-After": error["retry_after"]}
+        if error["retry_after"] is not None
+        else None,
+    )
+
+
+class TraceRecorder:
+    """Writes a trace of the running session to `path`, replacing it
+
+    Safe to use from the worker threads Spotipy runs in
+
+    Args:
+        path (Path): Where to write the gzipped json lines trace
+    """
+
+    __slots__ = "path", "file", "lock", "started", "pseudonymizer"
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.pseudonymizer = Pseudonymizer()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.write({"version": TRACE_VERSION})
+        logger.info(f"Recording Spotify traffic to {path}")
+
+    def write(self, record: Any) -> None:
+        """Appends a single record to the trace
+
+        Args:
+            record (Any): Json compatible
+        """
+        line = json_dumps(record, separators=(",", ":"))
+
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(f"{line}\n")
+
+    def elapsed_ms(self, since: float | None = None) -> float:
+        """Milliseconds from the start of the capture, or from `since`"""
+        return round((time.perf_counter() - (since or self.started)) * 1000, 3)
+
+    def api(
+        self,
+        account: str,
+        method: str,
+        args: tuple,
+        kwargs: dict,
+        started: float,
+        result: Any = None,
+        error: Exception | None = None,
+    ) -> None:
+        """Records a finished Spotipy call
+
+        Args:
+            account (str)
+            method (str): Name of the `Spotify` method
+            args (tuple)
+            kwargs (dict)
+            started (float): `time.perf_counter()` when the call was made
+            result (Any, optional): What Spotify answered. Defaults to None.
+            error (Exception | None, optional): What was raised instead.
+                Defaults to None.
+        """
+        scrub = self.pseudonymizer.scrub
+        self.write(
+            [
+                round((started - self.started) * 1000, 3),
+                API,
+                account,
+                method,
+                scrub(args),
+                scrub(kwargs),
+                self.elapsed_ms(started),
+                scrub(result),
+                None if error is None else describe_error(error),
+            ]
+        )
+
+    def command(self, account: str, payload: Any) -> None:
+        """Records a frame received from a websocket client
+
+        Args:
+            account (str): Account the client is subscribed to
+            payload (Any): The decoded frame
+        """
+        self.write(
+            [self.elapsed_ms(), COMMAND, account, self.pseudonymizer.scrub(payload)]
+        )
+
+    def connect(self, account: str, stream_playlists: bool) -> None:
+        """Records an account being connected to Spotify for a client
+
+        Args:
+            account (str)
+            stream_playlists (bool)
+        """
+        self.write([self.elapsed_ms(), CONNECT, account, stream_playlists])
+
+    def sent(self, account: str, action: str, size: int) -> None:
+        """Records a message sent to the clients of `account`
+
+        Args:
+            account (str)
+            action (str)
+            size (int): Encoded size in bytes
+        """
+        self.write([self.elapsed_ms(), SENT, account, action, size])
+
+    def wrap(self, spotify: Spotify, account: str) -> "RecordingSpotify":
+        """Wraps a Spotify connection so every call on it is recorded
+
+        Args:
+            spotify (Spotify)
+            account (str)
+
+        Returns:
+            RecordingSpotify
+        """
+        return RecordingSpotify(spotify, account, self)
+
+    def close(self) -> None:
+        """Finishes the trace"""
+        with self.lock:
+            self.file.close()
+
+
+class RecordingSpotify:
+    """Proxy around `Spotify` that records its public method calls
+
+    Args:
+        spotify (Spotify)
+        account (str)
+        recorder (TraceRecorder)
+    """
+
+    __slots__ = "spotify", "account", "recorder"
+
+    def __init__(self, spotify: Spotify, account: str, recorder: TraceRecorder):
+        self.spotify = spotify
+        self.account = account
+        self.recorder = recorder
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.spotify, name)
+
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def recorded(*args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                result = attribute(*args, **kwargs)
+            except (SpotifyException, RequestException) as error:
+                self.recorder.api(
+                    self.account, name, args, kwargs, started, error=error
+                )
+                raise
+
+            self.recorder.api(self.account, name, args, kwargs, started, result)
+            return result
+
+        return recorded
+
+
+def load_trace(path: Path) -> list[list]:
+    """Reads the records of a trace, skipping its header
+
+    A capture that was killed before it finished is read up to its last
+    complete record
+
+    Args:
+        path (Path)
+
+    Raises:
+        ValueError: The trace was written by an incompatible version
+
+    Returns:
+        list[list]: Records in the order they were written
+    """
+    records = []
+
+    with gzip.open(path, "rt", encoding="utf-8") as trace:
+        try:
+            for line in trace:
+                if not line.endswith("\n"):
+                    break
+                records.append(json_loads(line))
+        except EOFError:
+            logger.warning(f"{path} was cut short, replaying what was recorded")
+
+    if not records or records[0] != {"version": TRACE_VERSION}:
+        raise ValueError(f"{path} isn't a version {TRACE_VERSION} trace")
+
+    return records[1:]
+
+
+def call_key(args: Any, kwargs: dict) -> str:
+    """Key of a call's arguments, the same whether they were recorded or
+    passed on replay
+
+    Args:
+        args (Any)
+        kwargs (dict)
+
+    Returns:
+        str
+    """
+    return json_dumps([args, kwargs], sort_keys=True, default=str)
+
+
+class ReplaySpotify:
+    """Stands in for `Spotify` using the api records of one account
+
+    Each call is answered with the latest recorded response, as of
+    `clock()`, of a call with the same method and arguments, or of the same
+    method if those arguments were never seen. Those fallbacks are counted
+    in `fallbacks`, as they replay a response meant for another call. It
+    takes as long as the recorded call did, divided by `speed`
+
+    Args:
+        records (list[list]): `API` records of the account
+        clock (Callable[[], float]): Current position in the trace in ms
+        speed (float, optional): 0 answers right away. Defaults to 1.0.
+    """
+
+    __slots__ = "by_call", "by_method", "clock", "speed", "calls", "fallbacks", "lock"
+
+    auth_manager = None
+
+    def __init__(
+        self, records: list[list], clock: Callable[[], float], speed: float = 1.0
+    ) -> None:
+        self.by_call: dict[tuple, tuple[list, list]] = {}
+        self.by_method: dict[str, tuple[list, list]] = {}
+        self.clock = clock
+        self.speed = speed
+        self.calls: Counter[str] = Counter()
+        self.fallbacks: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+        # Calls are recorded as they finish, but looked up by when they started
+        for record in sorted(records, key=lambda record: record[0]):
+            started, _, _, method, args, kwargs, elapsed, result, error = record
+            answer = (elapsed, json_dumps(result), error)
+
+            for index in (
+                self.by_call.setdefault((method, call_key(args, kwargs)), ([], [])),
+                self.by_method.setdefault(method, ([], [])),
+            ):
+                index[0].append(started)
+                index[1].append(answer)
+
+    def __getattr__(self, method: str) -> Callable:
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def replayed(*args, **kwargs):
+            with self.lock:
+                self.calls[method] += 1
+
+            if (index := self.by_call.get((method, call_key(args, kwargs)))) is None:
+                if (index := self.by_method.get(method)) is None:
+                    with self.lock:
+                        self.calls["(unrecorded)"] += 1
+                    return None
+
+                with self.lock:
+                    self.fallbacks[method] += 1
+
+            times, answers = index
+            position = max(bisect_right(times, self.clock()) - 1, 0)
+            elapsed, result, error = answers[position]
+
+            if self.speed:
+                time.sleep(elapsed / 1000 / self.speed)
+
+            if error is not None:
+                raise rebuild_error(error)
+
+            return json_loads(result)
+
+        return replayed
+
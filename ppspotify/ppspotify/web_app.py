@@ -1,25 +1,190 @@
 """Custom wrapper for `aiohttp.web.Application"""
 
 import asyncio
+from json import dumps as json_dumps
+from pathlib import Path
 from typing import Any
 
 from aiohttp.web import Application, WebSocketResponse
 from loguru import logger
 
-from .context import SpotifyContext
+from .artwork import ArtworkPipeline
+from .context import (
+    ARTWORK_CACHE_DIR,
+    AUDIO_FEATURES_PATH,
+    DEFAULT_ACCOUNT,
+    SERVER_SETTINGS_PATH,
+    TRACE_PATH,
+    WS_COMPRESSION,
+    WS_COMPRESSION_THRESHOLD,
+    SpotifyContext,
+    account_path,
+)
+from .features import AudioFeaturesCache
+from .scheduler import Scheduler, create_session
+from .store import ConfigStore
+from .trace import TraceRecorder
 
 
 class Server(Application):
-    """Custom wrapper for `aiohttp.web.Application"""
+    """Custom wrapper for `aiohttp.web.Application`
+
+    Hosts one `SpotifyContext` per account. Every context shares the same
+    HTTP session, `Scheduler`, `ArtworkPipeline` and `AudioFeaturesCache`,
+    and each websocket client is subscribed to exactly one account at a time
+
+    When `TRACE_PATH` is set every account's traffic is recorded to it by
+    the shared `TraceRecorder`, see `ppspotify.trace`
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.clients: set[WebSocketResponse] = set()
-        self.context: SpotifyContext = SpotifyContext()
+        self.clients: dict[WebSocketResponse, str] = {}
+        self.send_locks: dict[WebSocketResponse, asyncio.Lock] = {}
+        self.contexts: dict[str, SpotifyContext] = {}
+        self.session = create_session()
+        self.scheduler = Scheduler()
+        self.scheduler.on_state_change = self.broadcast_status
+        self.artwork = ArtworkPipeline(ARTWORK_CACHE_DIR)
+        self.features = AudioFeaturesCache(AUDIO_FEATURES_PATH)
+        self.settings = ConfigStore(SERVER_SETTINGS_PATH)
+        self.recorder = TraceRecorder(Path(TRACE_PATH)) if TRACE_PATH else None
         self.tasks: list[asyncio.Task] = []
 
-    async def broadcast(self, action: str, data: dict[str, Any] | None = None) -> None:
-        """Sends a message to all connected clients.
+    @property
+    def ws_compression(self) -> bool:
+        """Whether to offer permessage-deflate to websocket clients"""
+        return self.settings.get("ws_compression", WS_COMPRESSION)
+
+    @property
+    def ws_compression_threshold(self) -> int:
+        """Smallest frame, in bytes, worth compressing"""
+        return self.settings.get("ws_compression_threshold", WS_COMPRESSION_THRESHOLD)
+
+    def create_websocket(self) -> WebSocketResponse:
+        """Creates a websocket response that negotiates permessage-deflate
+        when `ws_compression` is on
+
+        Returns:
+            WebSocketResponse
+        """
+        return WebSocketResponse(compress=self.ws_compression)
+
+    async def send(self, client: WebSocketResponse, message: str) -> None:
+        """Sends an already encoded message to a client, compressed if
+        deflate was negotiated and it's at least `ws_compression_threshold`.
+        Sends to the same client go out one at a time, in the order they
+        were made
+
+        Args:
+            client (WebSocketResponse)
+            message (str): Json encoded message
+        """
+        async with self.send_locks.setdefault(client, asyncio.Lock()):
+            if client.compress:
+                # Once deflate is negotiated aiohttp compresses every frame with
+                # the connection's compressor, so switch it on only for the big
+                # frames. Big ones are compressed in a task of their own that
+                # uncompressed frames don't wait for, hence the lock
+                client._writer.compress = (  # pylint: disable=protected-access
+                    client.compress
+                    if len(message) >= self.ws_compression_threshold
+                    else 0
+                )
+
+            await client.send_str(message)
+
+    def get_context(self, account: str) -> SpotifyContext:
+        """Gets the context for `account`, creating it if needed
+
+        Args:
+            account (str)
+
+        Raises:
+            ValueError: `account` isn't a valid account name
+
+        Returns:
+            SpotifyContext
+        """
+        if (context := self.contexts.get(account)) is None:
+            account_path(account)  # Validates the name before it's used anywhere
+            context = self.contexts[account] = SpotifyContext(
+                account=account,
+                session=self.session,
+                scheduler=self.scheduler,
+                artwork=self.artwork,
+                features=self.features,
+                recorder=self.recorder,
+            )
+
+        return context
+
+    def context_for(self, client: WebSocketResponse | None) -> SpotifyContext:
+        """Gets the context of the account `client` is subscribed to
+
+        Args:
+            client (WebSocketResponse | None)
+
+        Returns:
+            SpotifyContext
+        """
+        return self.get_context(self.clients.get(client, DEFAULT_ACCOUNT))
+
+    def subscribe(self, client: WebSocketResponse, account: str) -> SpotifyContext:
+        """Subscribes `client` to the events of `account`, releasing the
+        account it was subscribed to before
+
+        Args:
+            client (WebSocketResponse)
+            account (str)
+
+        Returns:
+            SpotifyContext: The context for `account`
+        """
+        context = self.get_context(account)
+        previous = self.clients.get(client)
+        self.clients[client] = account
+
+        if previous is not None and previous != account:
+            self.release(previous)
+
+        return context
+
+    def unsubscribe(self, client: WebSocketResponse) -> None:
+        """Forgets a client that disconnected, releasing its account
+
+        Args:
+            client (WebSocketResponse)
+        """
+        self.send_locks.pop(client, None)
+
+        if (account := self.clients.pop(client, None)) is not None:
+            self.release(account)
+
+    def release(self, account: str) -> None:
+        """Disconnects the context of `account` from Spotify once no client
+        is subscribed to it, so nobody polls Spotify for an account no one
+        is listening to. It's kept around and reconnects on the next subscribe
+
+        Args:
+            account (str)
+        """
+        if account in self.clients.values():
+            return
+
+        if (context := self.contexts.get(account)) is not None and (
+            context.spotify is not None
+        ):
+            logger.info(f"No clients left for {account}, disconnecting it")
+            context.close()
+
+    async def broadcast(
+        self,
+        action: str,
+        data: dict[str, Any] | None = None,
+        account: str = DEFAULT_ACCOUNT,
+    ) -> None:
+        """Sends a message to all clients subscribed to `account`.
         There should only be one client connected and it should be PolyPop,
         but just in case PolyPop retries connection and this client keeps an
         old connection alive for no reason we will broadcast it out to all connections
@@ -28,19 +193,47 @@ class Server(Application):
             app (web.Application)
             action (str): The action to perform in PolyPop
             data (dict, optional): Data related to the action
+            account (str, optional): Account the message is about.
+                Defaults to DEFAULT_ACCOUNT.
         """
-        for client in self.clients:
+        message = json_dumps(
+            {"action": action, "data": data} if data else {"action": action}
+        )
+
+        if self.recorder is not None:
+            self.recorder.sent(account, action, len(message))
+
+        for client, subscribed in list(self.clients.items()):
+            if subscribed != account:
+                continue
+
             try:
-                if data:
-                    await client.send_json({"action": action, "data": data})
-                else:
-                    await client.send_json({"action": action})
+                await self.send(client, message)
             except ConnectionResetError:
                 logger.warning(f"Connection reset.")
 
+    async def broadcast_status(self, status: dict) -> None:
+        """Lets every client know when Spotify becomes degraded or recovers
+
+        Args:
+            status (dict): `Scheduler.status`
+        """
+        for account in set(self.clients.values()):
+            await self.broadcast("service_status", status, account)
+
     def close(self):
         """Cleans up Server"""
         for task in self.tasks:
             task.cancel()
 
-        self.context.close()  # Type: Ignore
+        for context in self.contexts.values():
+            context.close()  # Type: Ignore
+
+        self.session.close()
+        self.scheduler.close()
+        self.artwork.close()
+        self.features.flush()
+        self.settings.flush()
+
+        if self.recorder is not None:
+            self.recorder.close()
@@ -0,0 +1,8 @@
+"""Keeps the service's files in a throwaway home directory during tests"""
+
+import os
+import tempfile
+
+# Must happen before `ppspotify` is imported, its paths are based on the home directory
+os.environ["HOME"] = os.environ["USERPROFILE"] = tempfile.mkdtemp(prefix="ppspotify-")
+os.environ.pop("PPSPOTIFY_TRACE", None)
@@ -0,0 +1,109 @@
+import asyncio
+import io
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from ppspotify.artwork import ArtworkPipeline, select_image, transcode
+
+
+def image_bytes(width: int, height: int, image_format: str = "PNG") -> bytes:
+    output = io.BytesIO()
+    Image.new("RGBA", (width, height), (200, 40, 40, 128)).save(output, image_format)
+    return output.getvalue()
+
+
+class BrokenPool:
+    """Fails every job like a pool whose workers were killed"""
+
+    def __init__(self) -> None:
+        self.shut_down = False
+
+    def submit(self, *args) -> Future:
+        future: Future = Future()
+        future.set_exception(BrokenProcessPool("killed"))
+        return future
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        self.shut_down = True
+
+
+def test_select_image_prefers_smallest_big_enough():
+    images = [
+        {"url": "640", "width": 640},
+        {"url": "64", "width": 64},
+        {"url": "300", "width": 300},
+    ]
+
+    assert select_image(images, 300)["url"] == "300"
+    assert select_image(images, 301)["url"] == "640"
+    assert select_image(images, 1000)["url"] == "640"
+    assert select_image([{"url": "unknown"}], 300)["url"] == "unknown"
+    assert select_image([], 300) is None
+
+
+def test_transcode_fits_box_and_format():
+    data = transcode(image_bytes(1000, 500), 300, "JPEG")
+
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.format == "JPEG"
+        assert image.mode == "RGB"
+        assert image.size == (300, 150)
+
+
+def test_process_caches_results(tmp_path):
+    pipeline = ArtworkPipeline(tmp_path)
+    data = image_bytes(600, 600)
+
+    async def process_twice():
+        try:
+            first = await pipeline.process(data, 64, "PNG")
+            first.write_bytes(b"cached")  # Any transcode would overwrite this
+            return first, await pipeline.process(data, 64, "PNG")
+        finally:
+            pipeline.close()
+
+    first, second = asyncio.run(process_twice())
+    assert first == second
+    assert first.suffix == ".png"
+    assert second.read_bytes() == b"cached"
+
+
+def test_undecodable_artwork_is_not_cached(tmp_path):
+    pipeline = ArtworkPipeline(tmp_path)
+    data = b"not an image"
+
+    async def process_twice():
+        try:
+            return [await pipeline.process(data) for _ in range(2)]
+        finally:
+            pipeline.close()
+
+    first, second = asyncio.run(process_twice())
+    assert first == second
+    assert first.read_bytes() == data
+    assert [path.name for path in tmp_path.iterdir()] == [first.name]
+    assert ".source." in first.name
+
+
+def test_broken_pool_is_shut_down(tmp_path):
+    pipeline = ArtworkPipeline(tmp_path)
+    pipeline.executor = pool = BrokenPool()  # type: ignore
+    data = image_bytes(600, 600)
+
+    path = asyncio.run(pipeline.process(data))
+
+    assert pool.shut_down
+    assert pipeline.executor is None
+    assert path.read_bytes() == data
+
+    try:
+        retried = asyncio.run(pipeline.process(data))
+    finally:
+        pipeline.close()
+
+    assert retried != path
+    with Image.open(retried) as image:
+        assert image.size == (300, 300)
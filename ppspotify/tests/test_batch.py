@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from spotipy.exceptions import SpotifyException
+
+from ppspotify.context import SpotifyContext
+from ppspotify.features import AudioFeaturesCache
+from ppspotify.ppspotify import run_batch
+
+
+class FakePlayer:
+    """Records the player commands it gets, in the order they ran"""
+
+    def __init__(self) -> None:
+        self.log: list[str] = []
+
+    def next_track(self):
+        time.sleep(0.05)  # Slower than `previous_track`, which must still wait
+        self.log.append("next")
+
+    def previous_track(self):
+        self.log.append("previous")
+
+    def pause_playback(self):
+        raise SpotifyException(403, -1, "Player command failed: Restriction violated")
+
+    def devices(self):
+        self.log.append("devices")
+        return {"devices": [{"name": "Desk", "id": "desk"}]}
+
+    def start_playback(self, **kwargs):
+        raise SpotifyException(404, -1, "Device not found", reason="NO_ACTIVE_DEVICE")
+
+    def current_user_playlists(self, limit, offset):
+        return {"items": [{"name": "Mix", "uri": "spotify:playlist:1"}], "next": None}
+
+
+class FakeServer:
+    """Collects what would be broadcast to PolyPop"""
+
+    def __init__(self) -> None:
+        self.sent: list[tuple] = []
+
+    async def broadcast(self, action, data=None, account=None):
+        self.sent.append((action, data))
+
+
+def run(commands: list, tmp_path, app=None) -> tuple[dict, FakePlayer]:
+    context = SpotifyContext(features=AudioFeaturesCache(tmp_path / "features.json"))
+    context.spotify = player = FakePlayer()  # type: ignore
+
+    return asyncio.run(run_batch(app, context, commands)), player  # type: ignore
+
+
+def test_results_match_commands(tmp_path):
+    result, _ = run(
+        [
+            {"id": 1, "action": "next"},
+            {"id": 2, "action": "get_devices"},
+            {"id": 3, "action": "dance"},
+            "not a command",
+        ],
+        tmp_path,
+    )
+    results = result["results"]
+
+    assert [entry["id"] for entry in results] == [1, 2, 3, None]
+    assert [entry["status"] for entry in results] == ["ok", "ok", "error", "error"]
+    assert results[1]["response"] == {
+        "action": "devices",
+        "data": {"devices": ["Desk"]},
+    }
+    assert results[2]["error"] == "Unknown action: dance"
+    assert result["elapsed_ms"] >= results[0]["elapsed_ms"]
+
+
+def test_player_commands_keep_their_order(tmp_path):
+    _, player = run(
+        [
+            {"id": 1, "action": "next"},
+            {"id": 2, "action": "previous"},
+            {"id": 3, "action": "get_devices"},
+        ],
+        tmp_path,
+    )
+
+    assert player.log.index("next") < player.log.index("previous")
+    assert player.log.index("devices") < player.log.index("next")  # Not held up
+
+
+def test_failures_are_reported_per_command(tmp_path):
+    result, _ = run(
+        [
+            {"id": 1, "action": "pause"},
+            {"id": 2, "action": "play", "data": {"track_uri": "spotify:track:1"}},
+            {"id": 3, "action": "previous"},
+        ],
+        tmp_path,
+    )
+    pause, play, previous = result["results"]
+
+    assert pause["status"] == "error"
+    assert "Restriction violated" in pause["error"]
+    assert play["status"] == "error"  # `play` answers with an error message
+    assert play["response"]["action"] == "error"
+    assert previous["status"] == "ok"
+
+
+def test_refresh_batch_from_plugin(tmp_path):
+    # What the plugin's Refresh action sends
+    app = FakeServer()
+    result, _ = run(
+        [
+            {"id": 1, "action": "refresh_devices"},
+            {"id": 2, "action": "refresh_playlists", "data": {"stream": True}},
+        ],
+        tmp_path,
+        app,
+    )
+    devices, playlists = result["results"]
+
+    assert devices["response"]["action"] == "devices"
+    assert playlists["status"] == "ok" and "response" not in playlists
+    assert app.sent == [
+        ("playlists_chunk", {"seq": 0, "playlists": {"Mix": "spotify:playlist:1"}}),
+        ("playlists_done", {"chunks": 1, "total": 1}),
+    ]
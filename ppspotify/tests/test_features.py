@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+from spotipy.exceptions import SpotifyException
+
+from ppspotify.context import SpotifyContext
+from ppspotify.features import AudioFeaturesCache
+
+
+def features(tempo: float) -> dict:
+    return {"tempo": tempo, "energy": 0.5, "uri": "dropped"}
+
+
+def test_keeps_only_known_fields(tmp_path):
+    cache = AudioFeaturesCache(tmp_path / "features.json")
+    cache.put("a", features(120))
+
+    assert cache.get("a")["tempo"] == 120
+    assert "uri" not in cache.get("a")
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = AudioFeaturesCache(tmp_path / "features.json", max_size=2)
+    cache.put("a", features(1))
+    cache.put("b", features(2))
+
+    cache.get("a")
+    cache.put("c", features(3))
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+
+
+def test_missing_remembers_tracks_without_features(tmp_path):
+    cache = AudioFeaturesCache(tmp_path / "features.json")
+    cache.put("a", None)
+
+    assert cache.missing(["a", "b", None, "b", "c"]) == ["b", "c"]
+
+
+def test_reload_keeps_order_and_size(tmp_path):
+    path = tmp_path / "features.json"
+    cache = AudioFeaturesCache(path)
+    for track_id in "abc":
+        cache.put(track_id, features(1))
+    cache.get("a")
+    cache.put("d", features(1))
+    cache.flush()
+
+    assert [entry[0] for entry in json.loads(path.read_text())] == list("bcad")
+
+    reloaded = AudioFeaturesCache(path, max_size=2)
+    assert list(reloaded.entries) == ["a", "d"]
+
+
+class Refusing:
+    """Refuses every audio features request with `status`"""
+
+    def __init__(self, status: int) -> None:
+        self.status = status
+        self.calls = 0
+
+    def audio_features(self, tracks: list) -> list:
+        self.calls += 1
+        raise SpotifyException(self.status, -1, "refused")
+
+
+def fetch(status: int, tmp_path) -> tuple[SpotifyContext, Refusing]:
+    context = SpotifyContext(features=AudioFeaturesCache(tmp_path / "features.json"))
+    context.spotify = spotify = Refusing(status)  # type: ignore
+
+    async def fetch_twice():
+        await context.fetch_audio_features(["a", "b"])
+        await context.fetch_audio_features(["a", "b"])
+
+    asyncio.run(fetch_twice())
+    return context, spotify
+
+
+def test_forbidden_turns_features_off(tmp_path):
+    context, spotify = fetch(403, tmp_path)
+
+    assert not context.features_enabled
+    assert spotify.calls == 1
+    assert context.features.missing(["a", "b"]) == []
+
+
+def test_refused_tracks_are_not_asked_for_again(tmp_path):
+    context, spotify = fetch(404, tmp_path)
+
+    assert context.features_enabled
+    assert spotify.calls == 1
+    assert "a" in context.features and context.features.get("a") is None
@@ -0,0 +1,162 @@
+import pytest
+
+from ppspotify import library
+from ppspotify.library import LibraryIndex, build_match_query
+
+
+def track(uri: str, name: str, artist: str = "Someone") -> dict:
+    return {
+        "uri": uri,
+        "name": name,
+        "artists": [{"name": artist}],
+        "album": {"name": "Album"},
+    }
+
+
+class FakeLibrary:
+    """Just enough of `Spotify` for `LibraryIndex.sync`"""
+
+    def __init__(self) -> None:
+        self.saved: list[dict] = []  # Newest first, like Spotify
+        self.playlists: dict[str, tuple[str, list[dict]]] = {}
+        self.playlist_fetches = 0
+
+    def save(self, added_at: str, item: dict) -> None:
+        self.saved.insert(0, {"added_at": added_at, "track": item})
+
+    def current_user_saved_tracks(self, limit: int, offset: int) -> dict:
+        items = self.saved[offset : offset + limit]
+        more = offset + limit < len(self.saved)
+        return {"items": items, "next": "more" if more else None}
+
+    def current_user_playlists(self, limit: int, offset: int) -> dict:
+        items = [
+            {
+                "uri": f"spotify:playlist:{playlist_id}",
+                "id": playlist_id,
+                "name": name,
+                "snapshot_id": str(hash(str(tracks))),
+                "owner": {"display_name": "Owner"},
+            }
+            for playlist_id, (name, tracks) in self.playlists.items()
+        ][offset : offset + limit]
+        return {"items": items, "next": None}
+
+    def playlist_items(
+        self, playlist_id: str, limit: int, offset: int, **kwargs
+    ) -> dict:
+        self.playlist_fetches += 1
+        tracks = self.playlists[playlist_id][1][offset : offset + limit]
+        return {"items": [{"track": item} for item in tracks], "next": None}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LibraryIndex(tmp_path / "library.db")
+    yield index
+    index.close()
+
+
+def uris(results: list[dict]) -> list[str]:
+    return [result["uri"] for result in results]
+
+
+def test_build_match_query_escapes_quotes():
+    assert build_match_query('daft "punk') == '"daft"* """punk"*'
+    assert build_match_query("   ") is None
+
+
+def test_sync_and_search(index):
+    spotify = FakeLibrary()
+    spotify.save("2024-01-01", track("spotify:track:1", "One More Time", "Daft Punk"))
+    spotify.playlists["p1"] = ("Road Trip", [track("spotify:track:2", "Harder Better")])
+
+    index.sync(spotify)
+
+    assert uris(index.search("daft one")) == ["spotify:track:1"]
+    assert uris(index.search("har")) == ["spotify:track:2"]
+    assert uris(index.search("road", kind="playlist")) == ["spotify:playlist:p1"]
+    assert index.search("road", kind="track") == []
+
+
+def test_incremental_sync_only_fetches_changes(index):
+    spotify = FakeLibrary()
+    spotify.save("2024-01-01", track("spotify:track:1", "Old"))
+    spotify.playlists["p1"] = ("Mix", [track("spotify:track:2", "Mixed")])
+    index.sync(spotify)
+
+    spotify.save("2024-02-01", track("spotify:track:3", "New"))
+    index.sync(spotify)
+
+    assert spotify.playlist_fetches == 1  # Its snapshot didn't change
+    assert uris(index.search("new")) == ["spotify:track:3"]
+    assert uris(index.search("old")) == ["spotify:track:1"]
+
+
+def test_removed_playlist_and_its_tracks_are_dropped(index):
+    spotify = FakeLibrary()
+    spotify.playlists["p1"] = ("Gone Soon", [track("spotify:track:2", "Vanishing")])
+    index.sync(spotify)
+
+    del spotify.playlists["p1"]
+    index.sync(spotify)
+
+    assert index.search("gone") == []
+    assert index.search("vanishing") == []
+
+
+def test_full_sync_drops_unsaved_tracks(index, monkeypatch):
+    spotify = FakeLibrary()
+    spotify.save("2024-01-01", track("spotify:track:1", "Unsaved"))
+    spotify.save("2024-01-02", track("spotify:track:2", "Kept"))
+    index.sync(spotify)
+
+    spotify.saved = [item for item in spotify.saved if item["added_at"].endswith("2")]
+    index.sync(spotify)
+    assert uris(index.search("unsaved")) == ["spotify:track:1"]  # Not a full sync yet
+
+    monkeypatch.setattr(library, "FULL_SYNC_INTERVAL", 0)
+    index.sync(spotify)
+
+    assert index.search("unsaved") == []
+    assert uris(index.search("kept")) == ["spotify:track:2"]
+
+
+def test_name_matches_outrank_album_matches(index):
+    spotify = FakeLibrary()
+    # Short fields score higher with equal column weights, so without the name
+    # weight the album match would come first
+    spotify.save(
+        "2024-01-01",
+        {
+            "uri": "spotify:track:album",
+            "name": "Intro",
+            "artists": [{"name": "X"}],
+            "album": {"name": "Sunrise"},
+        },
+    )
+    spotify.save(
+        "2024-01-02",
+        track("spotify:track:name", "Sunrise Over The Long Quiet Water", "Someone"),
+    )
+    index.sync(spotify)
+
+    assert uris(index.search("sunrise")) == [
+        "spotify:track:name",
+        "spotify:track:album",
+    ]
+
+
+def test_upcoming_follows_playlist_order(index):
+    spotify = FakeLibrary()
+    spotify.playlists["p1"] = (
+        "Mix",
+        [track(f"spotify:track:{n}", f"Song {n}") for n in (3, 1, 2, 5)],
+    )
+    index.sync(spotify)
+
+    assert index.upcoming("spotify:playlist:p1", "spotify:track:1", 2) == [
+        "spotify:track:2",
+        "spotify:track:5",
+    ]
+    assert index.upcoming("spotify:playlist:p1", "spotify:track:9", 2) == []
@@ -0,0 +1,206 @@
+import asyncio
+import io
+
+import pytest
+
+from PIL import Image
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from spotipy.exceptions import SpotifyException
+
+from ppspotify.artwork import ArtworkPipeline
+from ppspotify.context import LOOKAHEAD_DEPTH, SpotifyContext
+from ppspotify.features import AudioFeaturesCache
+from ppspotify.library import LibraryIndex
+
+
+def track(number: int) -> dict:
+    return {
+        "id": f"t{number}",
+        "uri": f"spotify:track:t{number}",
+        "name": f"Song {number}",
+        "is_local": False,
+        "album": {
+            "name": "Album",
+            "images": [
+                {"url": f"https://i.scdn.co/{number}/{size}", "width": size}
+                for size in (640, 300, 64)
+            ],
+        },
+    }
+
+
+class FakeSpotify:
+    def __init__(self, queue: list[dict] | None = None) -> None:
+        self.queue_items = queue or []
+        self.queue_error: Exception | None = None
+        self.calls: list[str] = []
+
+    def queue(self):
+        self.calls.append("queue")
+        if self.queue_error is not None:
+            raise self.queue_error
+        return {"currently_playing": track(0), "queue": self.queue_items}
+
+    def audio_features(self, tracks):
+        self.calls.append("audio_features")
+        return [{"tempo": 120.0} for _ in tracks]
+
+    def album_tracks(self, album_id, limit):
+        self.calls.append("album_tracks")
+        return {"items": [{"uri": f"spotify:track:t{n}"} for n in range(6)]}
+
+    def tracks(self, ids):
+        self.calls.append("tracks")
+        return {"tracks": [track(int(track_id[1:])) for track_id in ids]}
+
+
+def cover() -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", (640, 640), "red").save(output, "JPEG")
+    return output.getvalue()
+
+
+@pytest.fixture
+def downloads(monkeypatch) -> list[str]:
+    urls = []
+
+    def download_artwork(self, url):
+        urls.append(url)
+        return cover()
+
+    monkeypatch.setattr(SpotifyContext, "download_artwork", download_artwork)
+    return urls
+
+
+@pytest.fixture
+def context(tmp_path, downloads):
+    context = SpotifyContext(
+        artwork=ArtworkPipeline(tmp_path / "artwork"),
+        features=AudioFeaturesCache(tmp_path / "features.json"),
+    )
+    context.spotify = FakeSpotify()  # type: ignore
+    context.current_track = "t0"
+    yield context
+    context.artwork.close()
+
+
+def test_queue_is_pre_resolved(context, downloads):
+    context.spotify.queue_items = [track(n) for n in range(1, 6)]
+    asyncio.run(context.refresh_lookahead())
+
+    assert list(context.lookahead) == [
+        f"spotify:track:t{n}" for n in range(1, LOOKAHEAD_DEPTH + 1)
+    ]
+    images = context.lookahead["spotify:track:t1"]["album"]["images"]
+    assert images[0]["url"].startswith("file:")
+    assert images[1]["url"] == "https://i.scdn.co/1/300"  # Closest to artwork_size
+    assert downloads[0] == "https://i.scdn.co/1/300"
+    assert context.features.get("t1")["tempo"] == 120.0
+
+
+def test_entries_are_reused_between_refreshes(context, downloads):
+    context.spotify.queue_items = [track(1), track(2)]
+    asyncio.run(context.refresh_lookahead())
+    context.spotify.queue_items = [track(2), track(3)]
+    asyncio.run(context.refresh_lookahead())
+
+    assert list(context.lookahead) == ["spotify:track:t2", "spotify:track:t3"]
+    assert len(downloads) == 3
+
+
+def test_failed_download_keeps_spotify_images(context, monkeypatch):
+    def fail(self, url):
+        raise RequestsConnectionError("offline")
+
+    monkeypatch.setattr(SpotifyContext, "download_artwork", fail)
+    context.spotify.queue_items = [track(1)]
+    asyncio.run(context.refresh_lookahead())
+
+    images = context.lookahead["spotify:track:t1"]["album"]["images"]
+    assert images[0]["url"] == "https://i.scdn.co/1/300"
+
+
+def test_album_is_used_when_queue_is_unreadable(context):
+    context.spotify.queue_error = SpotifyException(403, -1, "forbidden")
+    context.current_track = "t2"
+    context.current_context = "spotify:album:a1"
+    asyncio.run(context.refresh_lookahead())
+
+    assert list(context.lookahead) == [
+        "spotify:track:t3",
+        "spotify:track:t4",
+        "spotify:track:t5",
+    ]
+
+
+def test_playlist_is_read_from_library(context, tmp_path):
+    class Playlists:
+        def current_user_saved_tracks(self, limit, offset):
+            return {"items": [], "next": None}
+
+        def current_user_playlists(self, limit, offset):
+            playlist = {"uri": "spotify:playlist:p1", "id": "p1", "name": "Mix"}
+            return {"items": [playlist | {"snapshot_id": "1"}], "next": None}
+
+        def playlist_items(self, playlist_id, **kwargs):
+            return {"items": [{"track": track(n)} for n in (7, 0, 8)], "next": None}
+
+    context.library = LibraryIndex(tmp_path / "library.db")
+    context.library.sync(Playlists())
+    context.current_context = "spotify:playlist:p1"
+    asyncio.run(context.refresh_lookahead())
+
+    assert list(context.lookahead) == ["spotify:track:t8"]
+    assert "album_tracks" not in context.spotify.calls
+    context.library.close()
+
+
+def test_nothing_is_guessed_while_shuffling(context):
+    context.current_context = "spotify:album:a1"
+    context.shuffle_state = True
+    asyncio.run(context.refresh_lookahead())
+
+    assert context.lookahead == {}
+    assert "album_tracks" not in context.spotify.calls
+
+
+def test_resolve_track_uses_and_drops_lookahead(context):
+    context.spotify.queue_items = [track(1)]
+    asyncio.run(context.refresh_lookahead())
+    pre_resolved = context.lookahead["spotify:track:t1"]
+
+    resolved = asyncio.run(context.resolve_track({"item": track(1)}))
+
+    assert resolved["item"] is pre_resolved
+    assert resolved["audio_features"]["tempo"] == 120.0
+    assert context.lookahead == {}
+
+
+def test_resolve_track_without_lookahead_never_waits(context, downloads):
+    resolved = asyncio.run(context.resolve_track({"item": track(9)}))
+
+    assert resolved["item"]["album"]["images"][0]["url"] == "https://i.scdn.co/9/300"
+    assert resolved["audio_features"] is None
+    assert downloads == []
+    assert context.spotify.calls == []
+
+
+def test_artwork_settings_invalidate_lookahead(context):
+    context.spotify.queue_items = [track(1)]
+    asyncio.run(context.refresh_lookahead())
+
+    asyncio.run(context.update_settings({"artwork_size": 64}))
+
+    assert context.lookahead == {}
+
+
+def test_schedule_lookahead_runs_one_refresh_at_a_time(context):
+    async def schedule_twice():
+        context.schedule_lookahead()
+        first = context.lookahead_task
+        context.schedule_lookahead()
+        assert context.lookahead_task is first
+        await first
+
+    asyncio.run(schedule_twice())
+    assert context.spotify.calls.count("queue") == 1
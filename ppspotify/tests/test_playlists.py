@@ -0,0 +1,82 @@
+import asyncio
+
+from loguru import logger
+from spotipy.exceptions import SpotifyException
+
+from ppspotify import scheduler
+from ppspotify.context import PLAYLIST_PAGE_SIZE, SpotifyContext
+from ppspotify.ppspotify import stream_in_background
+
+
+class FakeServer:
+    """Collects what would be broadcast to PolyPop"""
+
+    def __init__(self) -> None:
+        self.sent: list[tuple] = []
+
+    async def broadcast(self, action, data=None, account=None):
+        self.sent.append((action, data))
+
+
+class FakePlaylists:
+    """Pages through `total` playlists like `current_user_playlists`"""
+
+    def __init__(self, total: int) -> None:
+        self.total = total
+
+    def current_user_playlists(self, limit: int, offset: int) -> dict:
+        end = min(offset + limit, self.total)
+        return {
+            "items": [
+                {"name": f"Playlist {n}", "uri": f"spotify:playlist:{n}"}
+                for n in range(offset, end)
+            ],
+            "next": "more" if end < self.total else None,
+        }
+
+
+class Broken:
+    def current_user_playlists(self, limit: int, offset: int) -> dict:
+        raise SpotifyException(404, -1, "missing")
+
+
+def stream(spotify) -> list[tuple]:
+    app = FakeServer()
+    context = SpotifyContext()
+    context.spotify = spotify
+
+    asyncio.run(stream_in_background(app, context))  # type: ignore
+    return app.sent
+
+
+def test_playlists_streamed_in_order():
+    total = PLAYLIST_PAGE_SIZE * 2 + 7
+    sent = stream(FakePlaylists(total))
+
+    chunks = [data for action, data in sent[:-1] if action == "playlists_chunk"]
+    assert [chunk["seq"] for chunk in chunks] == [0, 1, 2]
+    sizes = [len(chunk["playlists"]) for chunk in chunks]
+    assert sizes == [PLAYLIST_PAGE_SIZE, PLAYLIST_PAGE_SIZE, 7]
+    assert chunks[0]["playlists"]["Playlist 0"] == "spotify:playlist:0"
+    assert sent[-1] == ("playlists_done", {"chunks": 3, "total": total})
+
+
+def test_no_playlists_still_done():
+    assert stream(FakePlaylists(0)) == [
+        ("playlists_chunk", {"seq": 0, "playlists": {}}),
+        ("playlists_done", {"chunks": 1, "total": 0}),
+    ]
+
+
+def test_stream_failures_are_logged(monkeypatch):
+    monkeypatch.setattr(scheduler, "backoff_delay", lambda attempt: 0)
+    warnings: list[str] = []
+    sink = logger.add(warnings.append, level="WARNING")
+
+    try:
+        sent = stream(Broken())
+    finally:
+        logger.remove(sink)
+
+    assert not sent
+    assert any("Streaming playlists" in warning for warning in warnings)
@@ -0,0 +1,179 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from spotipy.exceptions import SpotifyException
+
+from ppspotify import resilience, scheduler
+from ppspotify.resilience import (
+    CLOSED,
+    FAILURE_THRESHOLD,
+    HALF_OPEN,
+    MAX_RETRIES,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+)
+from ppspotify.scheduler import ScheduledClient, Scheduler
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(scheduler, "backoff_delay", lambda attempt: 0)
+
+
+def expire(breaker: CircuitBreaker) -> None:
+    breaker.opened_at -= breaker.open_for
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker("me")
+
+    for _ in range(FAILURE_THRESHOLD - 1):
+        assert not breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    assert breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_in > 0
+
+
+def test_breaker_lets_one_probe_through():
+    breaker = CircuitBreaker("me")
+    for _ in range(FAILURE_THRESHOLD):
+        breaker.record_failure()
+
+    expire(breaker)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    assert breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_for_longer(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    breaker = CircuitBreaker("me")
+    for _ in range(FAILURE_THRESHOLD):
+        breaker.record_failure()
+    first = breaker.open_for
+
+    expire(breaker)
+    breaker.allow()
+    assert not breaker.record_failure()  # Already counted as open
+    assert breaker.state == OPEN
+    assert breaker.open_for > first
+
+
+class Flaky:
+    """Fails the first `failures` calls with `error`"""
+
+    def __init__(self, error: Exception, failures: int = 1_000) -> None:
+        self.error = error
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return "ok"
+
+
+def server_error() -> SpotifyException:
+    return SpotifyException(503, -1, "unavailable")
+
+
+def test_scheduler_retries_server_errors():
+    func = Flaky(server_error(), failures=2)
+
+    assert asyncio.run(Scheduler().run("devices", func)) == "ok"
+    assert func.calls == 3
+
+
+def test_scheduler_never_repeats_writes():
+    func = Flaky(server_error())
+
+    with pytest.raises(SpotifyException):
+        asyncio.run(Scheduler().run("next_track", func))
+    assert func.calls == 1
+
+
+def test_scheduler_retries_rate_limited_writes():
+    func = Flaky(SpotifyException(429, -1, "slow", headers={"Retry-After": "0"}), 1)
+
+    assert asyncio.run(Scheduler().run("next_track", func)) == "ok"
+    assert func.calls == 2
+
+
+def test_scheduler_passes_client_errors_through():
+    func = Flaky(SpotifyException(404, -1, "missing"))
+    jobs = Scheduler()
+
+    with pytest.raises(SpotifyException):
+        asyncio.run(jobs.run("track", func))
+    assert func.calls == 1
+    assert jobs.breakers["track"].state == CLOSED
+
+
+def test_scheduler_opens_breaker_and_recovers():
+    jobs = Scheduler()
+    func = Flaky(RequestsConnectionError("down"))
+    calls_per_run = MAX_RETRIES + 1
+
+    async def run_until_open():
+        for _ in range(FAILURE_THRESHOLD):
+            with pytest.raises(RequestsConnectionError):
+                await jobs.run("devices", func)
+
+        with pytest.raises(CircuitOpenError):
+            await jobs.run("devices", func)
+
+    asyncio.run(run_until_open())
+    assert func.calls == FAILURE_THRESHOLD * calls_per_run
+    assert jobs.status == {"degraded": True, "endpoints": ["devices"]}
+
+    func.failures = 0
+    expire(jobs.breakers["devices"])
+    assert asyncio.run(jobs.run("devices", func)) == "ok"
+    assert jobs.status == {"degraded": False, "endpoints": []}
+
+
+def test_scheduler_ends_probe_on_unexpected_error():
+    jobs = Scheduler()
+    breaker = jobs.breakers["me"] = CircuitBreaker("me")
+    for _ in range(FAILURE_THRESHOLD):
+        breaker.record_failure()
+    expire(breaker)
+
+    with pytest.raises(KeyError):
+        asyncio.run(jobs.run("me", Flaky(KeyError("bug"))))
+    assert breaker.state == OPEN
+
+
+class Client:
+    def me(self):
+        return "me"
+
+
+def test_jobs_leave_the_default_executor_to_their_calls():
+    async def sync_all():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(1))
+        jobs = Scheduler()
+        client = ScheduledClient(Client(), jobs, loop)
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.gather(*(jobs.run_job(client.me) for _ in range(3))), 5
+            )
+        finally:
+            jobs.close()
+
+    assert asyncio.run(sync_all()) == ["me"] * 3
@@ -0,0 +1,216 @@
+import asyncio
+
+import pytest
+
+from aiohttp.test_utils import TestClient, TestServer
+from requests import Session
+from spotipy import Spotify
+
+from ppspotify.context import SpotifyContext
+from ppspotify.ppspotify import handle_actions, websocket_handler
+from ppspotify.scheduler import SharedSession
+from ppspotify.web_app import Server
+
+
+class FakeClient:
+    """Stands in for a websocket, collecting what it's sent"""
+
+    compress = 0
+
+    def __init__(self) -> None:
+        self.sent: list[str] = []
+
+    async def send_str(self, message: str) -> None:
+        self.sent.append(message)
+
+
+class FakeSpotify:
+    def __init__(self, profile: dict | None = None) -> None:
+        self.profile = profile
+
+    def me(self):
+        return self.profile
+
+    def current_playback(self):
+        return {"shuffle_state": False, "repeat_state": "off", "is_playing": False}
+
+    def devices(self):
+        return {"devices": []}
+
+    def currently_playing(self):
+        return None
+
+
+def run(coroutine_function):
+    """Runs a test body with a `Server` that's closed afterwards"""
+
+    async def main():
+        app = Server()
+        try:
+            return await coroutine_function(app)
+        finally:
+            app.close()
+
+    return asyncio.run(main())
+
+
+def connected(app: Server, account: str) -> SpotifyContext:
+    context = app.get_context(account)
+    context.spotify = FakeSpotify()  # type: ignore
+    return context
+
+
+def test_release_waits_for_the_last_client():
+    async def body(app):
+        first, second = FakeClient(), FakeClient()
+        context = app.subscribe(first, "default")
+        app.subscribe(second, "default")
+        connected(app, "default")
+
+        app.unsubscribe(first)
+        assert context.spotify is not None
+
+        app.unsubscribe(second)
+        assert context.spotify is None
+        assert app.clients == {}
+
+    run(body)
+
+
+def test_switching_accounts_releases_the_old_one():
+    async def body(app):
+        client = FakeClient()
+        app.subscribe(client, "first")
+        first = connected(app, "first")
+
+        app.subscribe(client, "second")
+
+        assert first.spotify is None
+        assert app.clients == {client: "second"}
+
+    run(body)
+
+
+def test_subscribing_again_keeps_the_connection(monkeypatch):
+    async def body(app):
+        client = FakeClient()
+        app.subscribe(client, "default")
+        context = connected(app, "default")
+
+        async def fail(*args, **kwargs):
+            raise AssertionError("Reconnected an account that was connected")
+
+        monkeypatch.setattr(SpotifyContext, "create_spotify", fail)
+        await handle_actions(app, ["subscribe", {"account": "default"}], client)
+
+        assert context.spotify is not None
+
+    run(body)
+
+
+def test_failed_connect_leaves_context_disconnected():
+    async def body(app):
+        context = app.get_context("default")
+
+        with pytest.raises(RuntimeError):
+            await context.create_spotify(app, spotify=FakeSpotify(profile=None))
+
+        assert context.spotify is None
+        assert context.tasks == []
+
+        profile = {"display_name": "Someone", "images": []}
+        action, data = await context.create_spotify(
+            app, stream_playlists=True, spotify=FakeSpotify(profile)
+        )
+        assert action == "spotify_connect" and data["name"] == "Someone"
+        assert context.spotify is not None and context.tasks
+
+    run(body)
+
+
+def test_handler_unsubscribes_after_failed_connect(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("Profile not found")
+
+    monkeypatch.setattr(SpotifyContext, "create_spotify", fail)
+
+    async def body(app):
+        app.router.add_get("/ws", websocket_handler)
+
+        async with TestClient(TestServer(app)) as client:
+            websocket = await client.ws_connect("/ws?account=someone")
+            await websocket.send_json(["refresh_devices"])
+            await websocket.close()
+
+            for _ in range(100):
+                if not app.clients:
+                    break
+                await asyncio.sleep(0.01)
+
+        assert app.clients == {}
+
+    run(body)
+
+
+def test_shared_session_outlives_spotify_objects(monkeypatch):
+    shared = Session()
+    adapter = shared.get_adapter("https://api.spotify.com")
+    closed = []
+    monkeypatch.setattr(adapter, "close", lambda: closed.append(adapter))
+
+    spotify = Spotify(auth="token", requests_session=SharedSession(shared))
+    assert spotify._session.get_adapter("https://api.spotify.com") is adapter
+    del spotify  # Spotipy closes its session here
+
+    assert closed == []
+
+    shared.close()
+    assert closed == [adapter]
+
+
+def test_sends_compress_big_frames_and_keep_order():
+    async def body(app):
+        app.settings.data["ws_compression"] = True
+        connected_clients: asyncio.Queue = asyncio.Queue()
+
+        async def handler(request):
+            websocket = app.create_websocket()
+            await websocket.prepare(request)
+            await connected_clients.put(websocket)
+            await websocket.receive()
+            return websocket
+
+        app.router.add_get("/ws", handler)
+
+        async with TestClient(TestServer(app)) as client:
+            websocket = await client.ws_connect("/ws", compress=15)
+            server_side = await connected_clients.get()
+            transport = server_side._writer.transport
+            write = transport.write
+            written: list[int] = []
+
+            def count(data):
+                written.append(len(data))
+                write(data)
+
+            transport.write = count
+
+            small = "s" * (app.ws_compression_threshold - 1)
+            big = "b" * 100_000  # Big enough for aiohttp to compress in a task
+
+            await app.send(server_side, small)
+            assert sum(written) == 4 + len(small)  # Header and the raw message
+
+            written.clear()
+            await app.send(server_side, big)
+            assert sum(written) < len(small)
+
+            await asyncio.gather(
+                *(app.send(server_side, message) for message in (big, small, big))
+            )
+            received = [(await websocket.receive()).data for _ in range(5)]
+            assert received == [small, big, big, small, big]
+
+            await websocket.close()
+
+    run(body)
@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+import pytest
+
+from loguru import logger
+
+from ppspotify import context
+from ppspotify.context import CredentialsManager, SpotifyContext
+from ppspotify.store import ConfigStore, JsonStore, read_json, write_atomic
+
+
+def test_write_atomic_replaces_file(tmp_path):
+    path = tmp_path / "nested" / "settings.json"
+
+    write_atomic(path, b"first")
+    write_atomic(path, b"second")
+
+    assert path.read_bytes() == b"second"
+    assert [file.name for file in path.parent.iterdir()] == ["settings.json"]
+
+
+def test_read_json_treats_corrupt_file_as_empty(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text("{not json")
+
+    assert read_json(path) is None
+    assert read_json(tmp_path / "missing.json") is None
+
+
+def test_config_store_flush_and_reload(tmp_path):
+    path = tmp_path / "settings.json"
+    store = ConfigStore(path)
+
+    store.set("artwork_size", 300)  # No running loop, so written right away
+    assert json.loads(path.read_text()) == {"artwork_size": 300}
+
+    assert ConfigStore(path).get("artwork_size") == 300
+    assert ConfigStore(path).get("missing", "default") == "default"
+
+
+def test_config_store_coalesces_writes(tmp_path):
+    path = tmp_path / "settings.json"
+
+    async def change_a_lot():
+        store = ConfigStore(path)
+        store.flush_delay = 0.01
+
+        for volume in range(50):
+            store.set("volume", volume)
+        assert not path.exists()
+
+        await asyncio.sleep(0.1)
+        return store
+
+    store = asyncio.run(change_a_lot())
+
+    assert json.loads(path.read_text()) == {"volume": 49}
+    assert store.written == store.version == 50
+
+
+def test_config_store_skips_unchanged_values(tmp_path):
+    store = ConfigStore(tmp_path / "settings.json")
+    store.set("volume", 10)
+    version = store.version
+
+    store.set("volume", 10)
+    assert store.version == version
+
+
+def test_stale_write_never_overwrites_newer(tmp_path):
+    path = tmp_path / "settings.json"
+    store = ConfigStore(path)
+    store.set("volume", 1)
+    stale = store.snapshot(), store.version
+
+    store.set("volume", 2)
+    store.write(*stale)  # e.g. a background write finishing after `flush`
+
+    assert json.loads(path.read_text()) == {"volume": 2}
+
+
+def test_json_store_needs_a_snapshot(tmp_path):
+    with pytest.raises(TypeError):
+        JsonStore(tmp_path / "store.json")  # type: ignore [abstract]
+
+
+def test_background_write_errors_are_logged(tmp_path):
+    path = tmp_path / "settings.json"
+    errors: list[str] = []
+    sink = logger.add(errors.append, level="ERROR")
+
+    async def set_unserializable():
+        store = ConfigStore(path)
+        store.flush_delay = 0.01
+        store.set("volume", object())
+        await asyncio.sleep(0.1)
+
+    try:
+        asyncio.run(set_unserializable())
+    finally:
+        logger.remove(sink)
+
+    assert not path.exists()
+    assert len(errors) == 1
+    assert "TypeError" in errors[0]
+
+
+def test_credentials_saved_only_when_needed(monkeypatch):
+    saved: list[CredentialsManager] = []
+    save_to_file = CredentialsManager.save_to_file
+
+    def save(credentials: CredentialsManager) -> None:
+        saved.append(credentials)
+        save_to_file(credentials)
+
+    monkeypatch.setattr(CredentialsManager, "save_to_file", save)
+    monkeypatch.setattr(context, "Spotify", lambda **kwargs: None)  # Never connect
+    monkeypatch.setattr(context.webbrowser, "open", lambda url: None)
+    spotify_context = SpotifyContext(account="credentials")
+
+    def login() -> None:
+        with pytest.raises(RuntimeError):
+            asyncio.run(spotify_context.create_spotify(None, "id", "secret"))
+
+    login()
+    login()  # Same credentials, already on disk
+    assert len(saved) == 1
+
+    spotify_context.request_credentials_from_user()  # Deletes the file
+    login()
+    assert len(saved) == 2
+    assert CredentialsManager.load_from_file("credentials") == saved[0]
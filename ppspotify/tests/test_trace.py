@@ -0,0 +1,165 @@
+import gzip
+
+import pytest
+
+from spotipy.exceptions import SpotifyException
+
+from ppspotify.trace import (
+    API,
+    Pseudonymizer,
+    ReplaySpotify,
+    TraceRecorder,
+    load_trace,
+)
+
+
+def test_pseudonyms_are_stable_and_private():
+    pseudonymizer = Pseudonymizer()
+    scrubbed = pseudonymizer.scrub(
+        {
+            "type": "user",
+            "display_name": "Someone",
+            "email": "someone@example.com",
+        }
+    )
+
+    assert scrubbed["type"] == "user"
+    assert scrubbed["display_name"] == pseudonymizer.pseudonym("Someone")
+    assert "someone@example.com" not in str(scrubbed)
+    assert Pseudonymizer().pseudonym("Someone") != scrubbed["display_name"]
+
+
+def test_scrub_keeps_tracks_but_hides_devices_and_users():
+    pseudonymizer = Pseudonymizer()
+    scrubbed = pseudonymizer.scrub(
+        {
+            "item": {"name": "Song", "uri": "spotify:track:1"},
+            "device": {"name": "Living Room", "volume_percent": 40},
+            "context": {"uri": "spotify:user:someone:collection"},
+            "device_name": "Living Room",
+        }
+    )
+
+    assert scrubbed["item"] == {"name": "Song", "uri": "spotify:track:1"}
+    assert scrubbed["device"]["name"] == scrubbed["device_name"]
+    assert "Living Room" not in str(scrubbed)
+    assert "someone" not in str(scrubbed)
+
+
+class FakeSpotify:
+    def __init__(self) -> None:
+        self.volume_percent = 10
+
+    def me(self):
+        return {"type": "user", "display_name": "Someone", "id": "someone"}
+
+    def track(self, track_id):
+        return {"id": track_id, "name": f"Song {track_id}"}
+
+    def volume(self, volume_percent):
+        self.volume_percent = volume_percent
+
+    def next_track(self):
+        raise SpotifyException(429, -1, "slow down", headers={"Retry-After": "3"})
+
+
+@pytest.fixture
+def trace(tmp_path):
+    path = tmp_path / "session.trace.gz"
+    recorder = TraceRecorder(path)
+    spotify = recorder.wrap(FakeSpotify(), "default")
+
+    spotify.me()
+    spotify.track("1")
+    spotify.track("2")
+    spotify.volume(50)
+    with pytest.raises(SpotifyException):
+        spotify.next_track()
+    recorder.command("default", ["update", {"volume": 50, "device_name": "Desk"}])
+    recorder.close()
+
+    return path
+
+
+def test_round_trip(trace):
+    records = load_trace(trace)
+    replay = ReplaySpotify(
+        [record for record in records if record[1] == API], lambda: 1e9, speed=0
+    )
+
+    assert replay.track("2") == {"id": "2", "name": "Song 2"}
+    assert replay.me()["display_name"].startswith("anon-")
+    assert replay.volume(50) is None
+
+    with pytest.raises(SpotifyException) as error:
+        replay.next_track()
+    assert error.value.http_status == 429
+    assert error.value.headers == {"Retry-After": "3"}
+
+    assert "Desk" not in str(records)
+    assert replay.calls["(unrecorded)"] == 0
+    assert not replay.fallbacks
+
+
+def test_replay_counts_fallbacks_and_unrecorded_calls(trace):
+    records = [record for record in load_trace(trace) if record[1] == API]
+    replay = ReplaySpotify(records, lambda: 1e9, speed=0)
+
+    assert replay.track("3") == {"id": "2", "name": "Song 2"}  # Latest `track` call
+    assert replay.devices() is None
+
+    assert replay.fallbacks == {"track": 1}
+    assert replay.calls["(unrecorded)"] == 1
+
+
+def test_replay_answers_as_of_clock(trace):
+    records = [record for record in load_trace(trace) if record[1] == API]
+    replay = ReplaySpotify(records, lambda: 0, speed=0)
+
+    assert replay.track("3") == {"id": "1", "name": "Song 1"}
+
+
+def test_load_trace_reads_cut_short_capture(trace, tmp_path):
+    cut = tmp_path / "cut.trace.gz"
+    data = gzip.decompress(trace.read_bytes())
+    cut.write_bytes(gzip.compress(data[: data.rindex(b"\n", 0, -1) + 5]))
+
+    assert len(load_trace(cut)) == len(load_trace(trace)) - 1
+
+
+def test_load_trace_rejects_other_versions(tmp_path):
+    path = tmp_path / "old.trace.gz"
+    path.write_bytes(gzip.compress(b'{"version": 0}\n'))
+
+    with pytest.raises(ValueError):
+        load_trace(path)
+
+
+class NoDevice:
+    def start_playback(self, device_id=None):
+        raise SpotifyException(
+            404,
+            -1,
+            "https://api.spotify.com/v1/me/player/play"
+            f"?device_id={device_id}:\n Player command failed: No active device found",
+            reason="NO_ACTIVE_DEVICE",
+        )
+
+
+def test_recorded_errors_leave_out_request_ids(tmp_path):
+    path = tmp_path / "session.trace.gz"
+    recorder = TraceRecorder(path)
+    spotify = recorder.wrap(NoDevice(), "default")
+
+    with pytest.raises(SpotifyException):
+        spotify.start_playback(device_id="a1b2c3d4e5")
+    recorder.close()
+
+    records = load_trace(path)
+    replay = ReplaySpotify(records, lambda: 1e9, speed=0)
+    with pytest.raises(SpotifyException) as error:
+        replay.start_playback(device_id="a1b2c3d4e5")
+
+    assert "a1b2c3d4e5" not in str(records)
+    assert error.value.msg.startswith("https://api.spotify.com/v1/me/player/play:")
+    assert error.value.reason == "NO_ACTIVE_DEVICE"